@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Benchmarks for the memory used per request.
+
+Uses the project of bench_pipeline.py and runs on the Python 2.7 of
+the SDK. For every scenario, it reports:
+
+- state: the objects and bytes of the controller's own per-request
+  state (its attributes and the containers and strings in them, not
+  the request and response that webapp2 makes), measured with
+  sys.getsizeof() when dispatch() ends;
+- retained: the objects tracked by the garbage collector that are
+  still alive after the request and a collection, which should be 0.
+
+	python bench/bench_alloc.py --sdk ~/google_appengine -o after.json
+	python bench/bench_alloc.py --sdk ~/google_appengine --compare before.json
+
+"""
+
+import gc
+import sys
+import argparse
+
+import common
+import bench_pipeline
+
+
+# Attributes of a controller that webapp2 sets, not the controller.
+SKIPPED = ('app', 'request', 'response')
+
+# Types whose instances are walked into; other objects (entities,
+# forms...) are the page's data rather than the controller's state.
+CONTAINERS = (dict, list, tuple, set)
+VALUES = (str, unicode, int, long, float, bool, type(None))
+
+
+def state_size(controller):
+	"""Count the objects and bytes of a controller's own state."""
+	seen = set()
+	objects = [0]
+	size = [0]
+	
+	def visit(obj):
+		if id(obj) in seen or not isinstance(obj, CONTAINERS + VALUES):
+			return
+		seen.add(id(obj))
+		objects[0] += 1
+		size[0] += sys.getsizeof(obj)
+		if isinstance(obj, dict):
+			for key, value in obj.iteritems():
+				visit(key)
+				visit(value)
+		elif isinstance(obj, CONTAINERS):
+			for item in obj:
+				visit(item)
+	
+	attributes = dict((k, v) for k, v in vars(controller).iteritems() if k not in SKIPPED)
+	size[0] += sys.getsizeof(vars(controller))
+	for name, value in attributes.iteritems():
+		visit(value)
+	return objects[0], size[0]
+
+
+def run(args):
+	common.load_sdk(args.sdk)
+	common.make_project(bench_pipeline.FILES)
+	
+	from lib import server, testing
+	
+	tb = testing.setup_testbed()
+	import main
+	from models.item import ItemModel
+	app = main.app
+	
+	# Measure the state of every controller when its dispatch() ends.
+	states = []
+	dispatch = server.BaseController.dispatch
+	def measured_dispatch(self):
+		try:
+			return dispatch(self)
+		finally:
+			states.append(state_size(self))
+	server.BaseController.dispatch = measured_dispatch
+	
+	def get(path):
+		bench_pipeline.check(testing.request(app, path), 200)
+	
+	def post(path, form):
+		bench_pipeline.check(testing.request(app, path, 'POST', form), 200, 302)
+	
+	ItemModel(**bench_pipeline.VALID).put()
+	first = ItemModel.query().get(keys_only=True).id()
+	
+	scenarios = [
+		('controller_get', lambda: get('/page')),
+		('index', lambda: get('/items')),
+		('index_json', lambda: get('/items.json')),
+		('show', lambda: get('/items/%d' % first)),
+		('new', lambda: get('/items/new')),
+		('post_invalid', lambda: post('/items', bench_pipeline.INVALID)),
+		('put', lambda: post('/items/%d' % first, dict(bench_pipeline.VALID, _method='PUT'))),
+	]
+	
+	results = {}
+	for name, fn in scenarios:
+		if args.only and name not in args.only:
+			continue
+		for _ in range(args.warmup):
+			fn()
+		
+		del states[:]
+		gc.collect()
+		before = len(gc.get_objects())
+		for _ in range(args.iterations):
+			fn()
+		gc.collect()
+		retained = len(gc.get_objects()) - before
+		
+		objects, size = states[-1]
+		results[name] = {
+			'n': len(states),
+			'objects': objects,
+			'bytes': size,
+			'retained': round(float(retained) / args.iterations, 2),
+		}
+		sys.stderr.write('%-28s %d objects, %d bytes\n' % (name, objects, size))
+	
+	return results
+
+
+def print_results(results):
+	"""Print the results as a table."""
+	print '%-28s%14s%14s%14s' % ('benchmark', 'state objs', 'state bytes', 'retained')
+	for name in sorted(results):
+		r = results[name]
+		print '%-28s%14s%14s%14s' % (name, r['objects'], r['bytes'], r['retained'])
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--sdk', help="path to the App Engine SDK (default: $APPENGINE_SDK)")
+	parser.add_argument('--iterations', type=int, default=50)
+	parser.add_argument('--warmup', type=int, default=5)
+	parser.add_argument('--only', nargs='+', metavar='SCENARIO',
+						help="only run the given scenarios")
+	parser.add_argument('-o', '--output', help="write the results to this JSON file")
+	parser.add_argument('--compare', metavar='JSON', help="compare with a previous run")
+	args = parser.parse_args()
+	
+	results = run(args)
+	print_results(results)
+	if args.compare:
+		common.compare(args.compare, results, keys=('objects', 'bytes', 'retained'))
+	if args.output:
+		common.write_results(args.output, results, iterations=args.iterations, warmup=args.warmup)
+
+
+if __name__ == '__main__':
+	main()
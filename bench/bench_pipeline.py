@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""Benchmarks for the request pipeline.
+
+A throwaway project is created from src/static with a generated model,
+controllers and views. Its WSGI app (main.app) is driven in-process on
+the App Engine testbed stubs, and each scenario is measured at several
+data sizes (the number of entities of the model):
+
+	python bench/bench_pipeline.py --sdk ~/google_appengine -o after.json
+	python bench/bench_pipeline.py --sdk ~/google_appengine --compare before.json
+
+"""
+
+import sys
+import argparse
+
+import common
+
+
+MODEL = '''from lib import db
+
+class ItemModel(db.Model):
+	name = db.string()
+	email = db.string()
+	price = db.integer(default=0)
+	description = db.text()
+	
+	form = {
+		"name": [db.validators.required(), db.validators.length(min=1, max=50)],
+		"email": [db.validators.required(), db.validators.email()],
+		"description": [db.validators.optional(), db.validators.escape()],
+	}
+'''
+
+MODEL_CONTROLLER = '''from controllers.core import ModelController
+from models.item import ItemModel
+
+class Item(ModelController):
+
+	model = ItemModel
+	
+	def index(self):
+		extension = self.request.get_extension()
+		if extension == "json":
+			self.render_json([r.to_dict() for r in self.resources])
+		elif extension == "xml":
+			self.render_xml([r.to_dict() for r in self.resources])
+'''
+
+CONTROLLER = '''from controllers.core import Controller
+
+class Page(Controller):
+
+	def index(self):
+		self.send_data(rows = range(50))
+'''
+
+BASE = '''<!DOCTYPE html>
+<html><head><title>{% block title %}{% endblock %}</title></head>
+<body><div class="container">{% block content %}{% endblock %}</div></body></html>
+'''
+
+INDEX = '''{% extends "layouts/base.html" %}
+{% block content %}<ul>
+{% for resource in resources %}<li><a href="{{ resource.link() }}">{{ resource.name }}</a> <a href="{{ resource.edit_link() }}">edit</a></li>
+{% endfor %}</ul>{% endblock %}
+'''
+
+SHOW = '''{% extends "layouts/base.html" %}
+{% block content %}<h1>{{ resource.name }}</h1><p>{{ resource.email }}</p><p>{{ resource.description }}</p>{% endblock %}
+'''
+
+FORM = '''{% extends "layouts/base.html" %}
+{% block content %}<form method="post">
+<input name="name" value="{{ resource.name }}"><input name="email" value="{{ resource.email }}">
+<textarea name="description">{{ resource.description }}</textarea></form>{% endblock %}
+'''
+
+NEW = '''{% extends "layouts/base.html" %}
+{% block content %}<form method="post">
+<input name="name"><input name="email">
+<textarea name="description"></textarea></form>{% endblock %}
+'''
+
+PAGE = '''{% extends "layouts/base.html" %}
+{% block content %}<table>{% for row in rows %}<tr><td>{{ row }}</td></tr>{% endfor %}</table>{% endblock %}
+'''
+
+FILES = {
+	'models/item.py': MODEL,
+	'controllers/item.py': MODEL_CONTROLLER,
+	'controllers/page.py': CONTROLLER,
+	'views/layouts/base.html': BASE,
+	'views/item/index.html': INDEX,
+	'views/item/show.html': SHOW,
+	'views/item/edit.html': FORM,
+	'views/item/new.html': NEW,
+	'views/page/index.html': PAGE,
+}
+
+VALID = {'name': 'Widget', 'email': 'widget@example.com', 'description': '<b>Useful</b> & cheap'}
+INVALID = {'name': '', 'email': 'not an email', 'description': ''}
+
+
+def check(response, *statuses):
+	"""Make sure a benchmarked request didn't fail."""
+	if response.status_int not in statuses:
+		raise AssertionError('unexpected %s:\n%s' % (response.status, response.body[:500]))
+
+
+def run(args):
+	common.load_sdk(args.sdk)
+	common.make_project(FILES)
+	
+	import webapp2
+	from google.appengine.ext import ndb
+	from lib import testing
+	
+	tb = testing.setup_testbed()
+	import main
+	from models.item import ItemModel
+	app = main.app
+	
+	def get(path):
+		check(testing.request(app, path), 200)
+	
+	def post(path, form):
+		check(testing.request(app, path, 'POST', form), 200, 302)
+	
+	def new_item():
+		return ItemModel(**VALID).put().id()
+	
+	results = {}
+	for size in args.sizes:
+		tb.deactivate()
+		tb = testing.setup_testbed()		# Start from an empty datastore
+		ndb.put_multi([ItemModel(name='Item %d' % i, email='item%d@example.com' % i,
+								 description='Description of item %d' % i, price=i)
+					   for i in range(size)])
+		first = ItemModel.query().get(keys_only=True).id()
+		
+		scenarios = [
+			('routing', lambda: app.router.match(webapp2.Request.blank('/items/%d/edit' % first)), None),
+			('controller_get', lambda: get('/page'), None),
+			('index', lambda: get('/items'), None),
+			('index_json', lambda: get('/items.json'), None),
+			('index_xml', lambda: get('/items.xml'), None),
+			('show', lambda: get('/items/%d' % first), None),
+			('edit', lambda: get('/items/%d/edit' % first), None),
+			('new', lambda: get('/items/new'), None),
+			('post', lambda: post('/items', VALID), None),
+			('post_invalid', lambda: post('/items', INVALID), None),
+			('put', lambda i: post('/items/%d' % i, dict(VALID, _method='PUT', name='Renamed')),
+			 lambda: (first,)),
+			('delete', lambda i: post('/items/%d' % i, {'_method': 'DELETE', '_resource_id': str(i)}),
+			 lambda: (new_item(),)),
+			('validate', lambda: ItemModel(validate=True, **VALID), None),
+			('validate_errors', lambda: ItemModel.get_errors(ItemModel.form, INVALID), None),
+		]
+		
+		for name, fn, setup in scenarios:
+			if args.only and name not in args.only:
+				continue
+			key = '%s@%d' % (name, size)
+			results[key] = common.measure(fn, args.iterations, args.warmup, setup)
+			sys.stderr.write('%-28s %s\n' % (key, results[key]['p50']))
+	
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--sdk', help="path to the App Engine SDK (default: $APPENGINE_SDK)")
+	parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+						help="numbers of entities to benchmark with")
+	parser.add_argument('--iterations', type=int, default=200)
+	parser.add_argument('--warmup', type=int, default=10)
+	parser.add_argument('--only', nargs='+', metavar='SCENARIO',
+						help="only run the given scenarios")
+	parser.add_argument('-o', '--output', help="write the results to this JSON file")
+	parser.add_argument('--compare', metavar='JSON', help="compare with a previous run")
+	args = parser.parse_args()
+	
+	results = run(args)
+	common.print_results(results)
+	if args.compare:
+		common.compare(args.compare, results)
+	if args.output:
+		common.write_results(args.output, results, sizes=args.sizes,
+							 iterations=args.iterations, warmup=args.warmup)
+
+
+if __name__ == '__main__':
+	main()
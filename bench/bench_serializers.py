@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Benchmarks for the response serializers.
+
+Encodes lists of serialized entities (like Model.serialize() returns)
+with each registered format and reports the encode time and payload
+size. MessagePack is measured with the pure-Python encoder, and with
+the msgpack package too if it's installed. The SDK isn't needed:
+
+	python bench/bench_serializers.py -o after.json
+	python bench/bench_serializers.py --compare before.json
+
+"""
+
+import sys
+import argparse
+
+import common
+
+
+def entities(n):
+	"""Make n entities as Model.serialize() returns them."""
+	return [{
+		'id': 5629499534213120 + i,
+		'name': u'Item %d' % i,
+		'email': 'item%d@example.com' % i,
+		'price': i * 100,
+		'rating': i / 7.0,
+		'available': i % 2 == 0,
+		'description': u'Description of item %d, which is useful and cheap.' % i,
+		'created': '2014-03-0%dT12:30:00.000000' % (i % 9 + 1),
+		'tags': ['tag%d' % (i % 5), 'tag%d' % (i % 7)],
+		'owner': 'ahFkZXZ-d2ViYXBwLWVuaGFuY2VkchELEgRVc2VyGICAgICAgIAKDA',
+	} for i in range(n)]
+
+
+def pure_pack(serializers, data):
+	"""Encode with the pure-Python MessagePack encoder, even when the
+	msgpack package is installed."""
+	chunks = []
+	serializers._pack(data, chunks.append)
+	return ''.join(chunks)
+
+
+def run(args):
+	sys.path.insert(0, common.STATIC_DIR)
+	from lib import serializers
+	
+	formats = [
+		('json', serializers.find('json').dumps),
+		('xml', serializers.find('xml').dumps),
+		('msgpack_pure', lambda d: pure_pack(serializers, d)),
+	]
+	if serializers.msgpack is not None:
+		formats.append(('msgpack', serializers.pack))
+	
+	results = {}
+	for size in args.sizes:
+		data = entities(size)
+		for name, dumps in formats:
+			if args.only and name not in args.only:
+				continue
+			key = '%s@%d' % (name, size)
+			results[key] = common.measure(lambda: dumps(data), args.iterations, args.warmup)
+			results[key]['bytes'] = len(dumps(data))
+			sys.stderr.write('%-28s %s ms, %d bytes\n' % (key, results[key]['p50'], results[key]['bytes']))
+	
+	return results
+
+
+def print_results(results):
+	"""Print the results as a table."""
+	print '%-28s%12s%12s%12s' % ('benchmark', 'p50 ms', 'p99 ms', 'bytes')
+	for name in sorted(results):
+		r = results[name]
+		print '%-28s%12s%12s%12s' % (name, r['p50'], r['p99'], r['bytes'])
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100],
+						help="numbers of entities to encode")
+	parser.add_argument('--iterations', type=int, default=50)
+	parser.add_argument('--warmup', type=int, default=10)
+	parser.add_argument('--only', nargs='+', metavar='FORMAT',
+						help="only run the given formats")
+	parser.add_argument('-o', '--output', help="write the results to this JSON file")
+	parser.add_argument('--compare', metavar='JSON', help="compare with a previous run")
+	args = parser.parse_args()
+	
+	results = run(args)
+	print_results(results)
+	if args.compare:
+		common.compare(args.compare, results, keys=('p50', 'p99', 'bytes'))
+	if args.output:
+		common.write_results(args.output, results, sizes=args.sizes,
+							 iterations=args.iterations, warmup=args.warmup)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,131 @@
+"""Shared helpers for the benchmark scripts."""
+
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import datetime
+
+
+# The project template that `we -n` copies.
+STATIC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'static'))
+
+
+def load_sdk(path=None):
+	"""Put the App Engine SDK (and its bundled libraries) on sys.path.
+	
+	The path defaults to the APPENGINE_SDK environment variable. If
+	neither is given, the SDK must already be importable.
+	
+	"""
+	path = path or os.environ.get('APPENGINE_SDK')
+	if path:
+		sys.path.insert(0, os.path.expanduser(path))
+		import dev_appserver
+		dev_appserver.fix_sys_path()
+
+
+def make_project(files):
+	"""Create a throwaway project from the template and make it current.
+	
+	files maps paths inside the project to their contents. The project
+	becomes the working directory (controllers are discovered from it)
+	and is put on sys.path. It is deleted when the process exits.
+	
+	"""
+	root = tempfile.mkdtemp(prefix='we-bench-')
+	atexit.register(shutil.rmtree, root, True)
+	
+	app_dir = os.path.join(root, 'app')
+	shutil.copytree(STATIC_DIR, app_dir, ignore=shutil.ignore_patterns('temp', '*.pyc'))
+	for path, content in files.items():
+		path = os.path.join(app_dir, path)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'w') as f:
+			f.write(content)
+	
+	os.chdir(app_dir)
+	sys.path.insert(0, app_dir)
+	return app_dir
+
+
+def measure(fn, iterations, warmup=10, setup=None):
+	"""Call fn repeatedly and summarize its latencies.
+	
+	If setup is given, it is called (untimed) before every call and
+	its result is passed to fn as arguments.
+	
+	"""
+	for _ in range(warmup):
+		fn(*(setup() if setup else ()))
+	
+	latencies = []
+	for _ in range(iterations):
+		args = setup() if setup else ()
+		start = time.time()
+		fn(*args)
+		latencies.append(time.time() - start)
+	return summarize(latencies)
+
+
+def summarize(latencies):
+	"""Return the throughput and latency percentiles (in milliseconds)."""
+	latencies = sorted(latencies)
+	total = sum(latencies)
+	return {
+		'n': len(latencies),
+		'rps': round(len(latencies) / total, 2) if total else None,
+		'mean': round(total / len(latencies) * 1000, 4),
+		'min': round(latencies[0] * 1000, 4),
+		'p50': round(percentile(latencies, 50) * 1000, 4),
+		'p90': round(percentile(latencies, 90) * 1000, 4),
+		'p99': round(percentile(latencies, 99) * 1000, 4),
+		'max': round(latencies[-1] * 1000, 4),
+	}
+
+
+def percentile(values, p):
+	"""Get the p-th percentile (nearest rank) of a sorted list."""
+	rank = int(-(-p * len(values) // 100)) - 1
+	return values[min(max(rank, 0), len(values) - 1)]
+
+
+def write_results(path, results, **meta):
+	"""Save the results (and the conditions they were taken in) as JSON."""
+	meta.update({
+		'python': sys.version.split()[0],
+		'platform': sys.platform,
+		'date': datetime.datetime.utcnow().isoformat(),
+	})
+	with open(path, 'w') as f:
+		json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+
+
+def compare(baseline_path, results, keys=('p50', 'p99', 'rps')):
+	"""Print the results next to the ones saved in a baseline file."""
+	with open(baseline_path) as f:
+		baseline = json.load(f)['results']
+	
+	print '%-28s' % 'benchmark' + ''.join('%24s' % k for k in keys)
+	for name in sorted(results):
+		row = '%-28s' % name
+		for k in keys:
+			new = results[name].get(k)
+			old = baseline.get(name, {}).get(k)
+			if old and new is not None:
+				row += '%24s' % ('%.3f -> %.3f (%+.1f%%)' % (old, new, (new - old) * 100.0 / old))
+			else:
+				row += '%24s' % new
+		print row
+
+
+def print_results(results):
+	"""Print the results as a table."""
+	print '%-28s%12s%12s%12s%12s' % ('benchmark', 'rps', 'p50 ms', 'p90 ms', 'p99 ms')
+	for name in sorted(results):
+		r = results[name]
+		print '%-28s%12s%12s%12s%12s' % (name, r.get('rps'), r.get('p50'), r.get('p90'), r.get('p99'))
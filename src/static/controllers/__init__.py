@@ -16,14 +16,13 @@ def package_contents(module_names):
 	return [importlib.import_module('controllers.' + m) for m in module_names]
 
 # Determine if the given object should be added to the router
-def should_route(obj):
+def should_route(obj, names=None):
 	if inspect.isclass(obj):
 		
 		# Format the object's name to variable-like name
 		lname = re.sub('([a-z0-9])([A-Z])', r'\1_\2', re.sub('(.)([A-Z][a-z]+)', r'\1_\2', obj.__name__)).lower()
 		
-		# TO-DO: Add upload and download classes
-		return lname in package_names()
+		return lname in (names if names is not None else package_names())
 
 
 def all_classes():
@@ -35,14 +34,16 @@ def all_classes():
 	"""
 	
 	classes = []
+	names = package_names()
+	listed = set(names)		# Listed once, not for every object
 	
 	# Go through all modules in the controllers package
-	for module in package_contents(package_names()):
+	for module in package_contents(names):
 		
 		# Go through all objects in the module and
 		# return the ones that are controllers
 		for name, obj in inspect.getmembers(module):
-			if should_route(obj):
+			if should_route(obj, listed):
 				classes.append(obj)
 	
 	return classes	
@@ -11,3 +11,12 @@ class ModelController(server.ModelController, ParentController):
 
 class AJAXController(server.AJAXController, ParentController):
 	pass
+
+class UploadController(server.UploadController, ParentController):
+	pass
+
+class DownloadController(server.DownloadController, ParentController):
+	pass
+
+class FeedController(server.FeedController, ParentController):
+	pass
@@ -1 +1 @@
-__all__ = ["db", "server"]
+__all__ = ["bulk", "cache", "db", "profiler", "serializers", "server", "stats", "tasks", "testing"]
@@ -0,0 +1,245 @@
+import os
+import csv
+import json
+import inspect
+import datetime
+import importlib
+import collections
+
+from google.appengine.api import datastore_errors, users
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from lib import db
+
+
+def find_model(name):
+	"""Get a model class from its name (e.g. "item", "Item" or "ItemModel").
+	The model must be defined in models/<lowercase name>.py.
+	"""
+	if name.endswith("Model"):
+		name = name[:-5]
+	module = importlib.import_module("models." + db._lowercase(name))
+	for _, obj in inspect.getmembers(module, inspect.isclass):
+		if issubclass(obj, ndb.Model) and obj.__module__ == module.__name__:
+			return obj
+	raise LookupError("no model found in %s" % module.__name__)
+
+
+def export(model, path, fmt="jsonl", batch_size=500, progress=None):
+	"""Write every entity of a model to a JSON lines or CSV file.
+	
+	Entities are read in batches with query cursors. After each batch,
+	the cursor is saved in a checkpoint file next to the output, so an
+	interrupted export continues where it stopped when run again.
+	Returns the number of exported entities.
+	
+	"""
+	checkpoint = _load_checkpoint(path)
+	cursor = Cursor(urlsafe=checkpoint["cursor"]) if checkpoint else None
+	count = checkpoint["rows"] if checkpoint else 0
+	fields = ["id"] + sorted(model._properties)
+	
+	with open(path, "r+b" if checkpoint else "wb") as f:
+		if checkpoint:
+			f.truncate(checkpoint["offset"])		# Drop rows written after the checkpoint
+			f.seek(0, os.SEEK_END)
+		writer = csv.DictWriter(f, fields) if fmt == "csv" else None
+		if writer and not checkpoint:
+			writer.writeheader()
+		
+		more = True
+		while more:
+			entities, cursor, more = model.query().fetch_page(batch_size, start_cursor=cursor)
+			for entity in entities:
+				data = entity.serialize()
+				if writer:
+					writer.writerow(dict((k, _csv_value(v)) for k, v in data.items() if k in fields))
+				else:
+					f.write(json.dumps(data, sort_keys=True) + "\n")
+			f.flush()
+			count += len(entities)
+			_save_checkpoint(path, {
+				"cursor": cursor.urlsafe() if cursor else None,
+				"rows": count,
+				"offset": f.tell(),
+			})
+			if progress: progress(count)
+	
+	_remove_checkpoint(path)
+	return count
+
+
+def import_(model, path, fmt="jsonl", batch_size=500, parallel=4, progress=None, errors=None):
+	"""Create or overwrite entities of a model from a JSON lines or CSV file.
+	
+	Rows are validated with the model's form, if it has one; invalid
+	rows are skipped and passed to errors(row number, message). Valid
+	ones are written in batches with put_multi, keeping up to the given
+	number of batches in flight. Progress is saved in a checkpoint file
+	next to the input, so an interrupted import continues where it
+	stopped when run again.
+	
+	NOTE: entities are written with put_multi rather than save(); if
+	the model is counted, its count is computed again at the end (and
+	if it's searchable, it's indexed again), and its generation is
+	changed. Imported entities aren't recorded in the model's feed.
+	
+	Returns the number of imported and skipped rows.
+	
+	"""
+	checkpoint = _load_checkpoint(path)
+	done = checkpoint["rows"] if checkpoint else 0
+	imported = skipped = 0
+	pending = collections.deque()
+	batch = []
+	
+	def wait_oldest():
+		futures, rows = pending.popleft()
+		for future in futures:
+			future.get_result()
+		_save_checkpoint(path, {"rows": rows})
+		if progress: progress(rows)
+	
+	with open(path, "rb") as f:
+		rows = csv.DictReader(f) if fmt == "csv" else (json.loads(l) for l in f if l.strip())
+		number = 0
+		for number, row in enumerate(rows, 1):
+			if number <= done:
+				continue
+			try:
+				batch.append(build(model, row, fmt == "csv"))
+			except (IOError, ValueError, TypeError, LookupError, datastore_errors.Error) as e:
+				skipped += 1
+				if errors: errors(number, str(e))
+				continue
+			
+			if len(batch) >= batch_size:
+				pending.append((ndb.put_multi_async(batch), number))
+				imported += len(batch)
+				batch = []
+				while len(pending) >= parallel:
+					wait_oldest()
+		
+		if batch:
+			pending.append((ndb.put_multi_async(batch), number))
+			imported += len(batch)
+		while pending:
+			wait_oldest()
+	
+	_remove_checkpoint(path)
+	if model.counted:
+		model.recount()
+	if model.searchable:
+		model.reindex(batch_size)
+	db.next_generation(model._get_kind())
+	return imported, skipped
+
+
+def build(model, row, from_csv=False):
+	"""Create an entity from an exported row.
+	
+	The row is checked with the model's form, but the values are kept
+	as exported: validators that transform values (like escape()) were
+	already applied when the entities were first saved.
+	Raises an IOError with the form's errors if the row isn't valid.
+	
+	"""
+	values = decode(model, row, from_csv)
+	entity_id = row.get("id")
+	if from_csv and entity_id:
+		entity_id = int(entity_id) if entity_id.isdigit() else entity_id
+	entity = model(id=entity_id or None, **values)
+	
+	form = model.form
+	if form is not None:
+		data = dict((field, values.get(field)) for field in form)
+		problems = model.get_errors(form, data)
+		if problems:
+			raise IOError(", ".join("%s: %s" % p for p in sorted(problems.items())))
+	return entity
+
+
+def decode(model, row, from_csv=False):
+	"""Convert the values of an exported row back to property values.
+	Columns that aren't properties of the model are ignored.
+	"""
+	values = {}
+	for name, value in row.items():
+		prop = model._properties.get(name)
+		if prop is None:
+			continue
+		if from_csv:
+			if value == "" and not isinstance(prop, ndb.TextProperty):
+				value = None
+			elif prop._repeated or isinstance(prop, ndb.JsonProperty):
+				value = json.loads(value)
+			elif isinstance(prop, ndb.TextProperty):
+				value = value.decode("utf-8")
+		if prop._repeated:
+			values[name] = [_decode(prop, v) for v in value or []]
+		else:
+			values[name] = _decode(prop, value)
+	return values
+
+
+# These are used within the module.
+def _decode(prop, value):
+	"""Convert a serialized value to the type of a property."""
+	if value is None or isinstance(prop, (ndb.TextProperty, ndb.JsonProperty)):
+		return value
+	if isinstance(prop, ndb.IntegerProperty):
+		return int(value)
+	if isinstance(prop, ndb.FloatProperty):
+		return float(value)
+	if isinstance(prop, ndb.BooleanProperty):
+		return value if isinstance(value, bool) else value.lower() in ("true", "1", "yes")
+	if isinstance(prop, ndb.DateProperty):
+		return _parse_datetime(value).date()
+	if isinstance(prop, ndb.TimeProperty):
+		return _parse_datetime("1970-01-01T" + value).time()
+	if isinstance(prop, ndb.DateTimeProperty):
+		return _parse_datetime(value)
+	if isinstance(prop, ndb.KeyProperty):
+		return ndb.Key(urlsafe=value)
+	if isinstance(prop, ndb.GeoPtProperty):
+		return ndb.GeoPt(value)
+	if isinstance(prop, ndb.UserProperty):
+		return users.User(value)
+	if isinstance(prop, ndb.BlobKeyProperty):
+		return ndb.BlobKey(value)
+	return value
+
+def _parse_datetime(s):
+	"""Parse a datetime written by isoformat()."""
+	if len(s) == 10:
+		s += "T00:00:00"
+	fmt = "%Y-%m-%dT%H:%M:%S.%f" if "." in s else "%Y-%m-%dT%H:%M:%S"
+	return datetime.datetime.strptime(s, fmt)
+
+def _csv_value(value):
+	"""Format a serialized value for a CSV cell."""
+	if value is None:
+		return ""
+	if isinstance(value, (list, dict)):
+		return json.dumps(value)
+	if isinstance(value, unicode):
+		return value.encode("utf-8")
+	return value
+
+def _checkpoint_path(path):
+	return path + ".checkpoint"
+
+def _load_checkpoint(path):
+	if os.path.exists(_checkpoint_path(path)):
+		with open(_checkpoint_path(path)) as f:
+			return json.load(f)
+
+def _save_checkpoint(path, data):
+	with open(_checkpoint_path(path) + ".tmp", "w") as f:
+		json.dump(data, f)
+	os.rename(_checkpoint_path(path) + ".tmp", _checkpoint_path(path))		# Atomic on POSIX
+
+def _remove_checkpoint(path):
+	if os.path.exists(_checkpoint_path(path)):
+		os.remove(_checkpoint_path(path))
@@ -0,0 +1,204 @@
+import sys
+import time
+import threading
+import collections
+
+from jinja2 import nodes, Markup
+from jinja2.ext import Extension
+
+from google.appengine.api import memcache
+
+
+# Seconds a fragment is cached for when the tag doesn't say.
+DEFAULT_TTL = 3600
+
+
+class LRUCache(object):
+	"""In-process cache that keeps the most recently used values.
+	
+	Values may have a time to live, in seconds. The cache is shared
+	by the threads of an instance, so it's guarded by a lock.
+	
+	The size is a number of values or, if a weigh function is given,
+	the total weight of the values (e.g. their size in bytes); values
+	heavier than the whole cache aren't kept.
+	
+	"""
+	
+	def __init__(self, size=1000, weigh=None):
+		self.size = size
+		self.weigh = weigh
+		self.weight = 0
+		self._data = collections.OrderedDict()
+		self._lock = threading.Lock()
+	
+	def get(self, key, default=None):
+		with self._lock:
+			item = self._data.pop(key, None)
+			if item is None:
+				return default
+			value, expires, weight = item
+			if expires and expires < time.time():
+				self.weight -= weight
+				return default
+			self._data[key] = item		# Most recently used goes last
+			return value
+	
+	def set(self, key, value, ttl=None):
+		weight = self.weigh(value) if self.weigh else 1
+		with self._lock:
+			self._pop(key)
+			if weight > self.size:
+				return
+			self._data[key] = (value, time.time() + ttl if ttl else None, weight)
+			self.weight += weight
+			while self.weight > self.size:
+				self.weight -= self._data.popitem(last=False)[1][2]
+	
+	def delete(self, key):
+		with self._lock:
+			self._pop(key)
+	
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.weight = 0
+	
+	def __len__(self):
+		return len(self._data)
+	
+	def _pop(self, key):
+		item = self._data.pop(key, None)
+		if item is not None:
+			self.weight -= item[2]
+
+
+class FragmentCache(object):
+	"""Two-level cache for rendered fragments of templates.
+	
+	Fragments are looked up in the instance's LRU cache first, then in
+	memcache, which is shared by all the instances of the app.
+	
+	"""
+	
+	def __init__(self, size=1000, prefix="fragment:"):
+		self.local = LRUCache(size)
+		self.prefix = prefix
+	
+	def get(self, key):
+		key = self.prefix + key
+		value = self.local.get(key)
+		if value is None:
+			value = memcache.get(key)
+		return value
+	
+	def set(self, key, value, ttl=DEFAULT_TTL):
+		key = self.prefix + key
+		self.local.set(key, value, ttl)
+		memcache.set(key, value, ttl or 0)
+	
+	def render(self, key, ttl, render):
+		"""Return the cached fragment, or render and cache it."""
+		value = self.get(key)
+		if value is None:
+			value = render()
+			self.set(key, value, ttl)
+		return value
+
+
+# Cache used by the {% cache %} tag.
+fragments = FragmentCache()
+
+
+class SingleFlight(object):
+	"""Share the result of a call among the threads that make it at
+	the same time.
+	
+	The first thread to call do() with a key runs the function; the
+	ones that call it with the same key meanwhile wait for its result
+	(or its exception) instead of running it again.
+	
+	"""
+	
+	def __init__(self, timeout=30):
+		self.timeout = timeout		# Seconds to wait before running the function anyway
+		self.calls = 0
+		self.coalesced = 0
+		self._lock = threading.Lock()
+		self._calls = {}
+	
+	def do(self, key, fn):
+		"""Call fn, or wait for the call with the same key in flight.
+		Returns its result and whether it was shared."""
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = _Call()
+				self.calls += 1
+			else:
+				self.coalesced += 1
+		
+		if not leader:
+			if call.done.wait(self.timeout):
+				if call.error:
+					raise call.error[0], call.error[1], call.error[2]
+				return call.result, True
+			return fn(), False
+		
+		try:
+			call.result = fn()
+		except Exception:
+			call.error = sys.exc_info()
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call.done.set()
+		return call.result, False
+
+
+class FragmentCacheExtension(Extension):
+	"""Jinja2 extension adding the {% cache %} tag, e.g.:
+	
+	    {% cache "sidebar", 600 %}...{% endcache %}
+	    {% cache ("card", resource.cache_key()) %}...{% endcache %}
+	
+	The key is a string or a tuple of values, which are joined. The
+	time to live, in seconds, is optional. Include a model's generation
+	or an entity's cache_key() in the key to render the fragment again
+	when the data changes.
+	
+	"""
+	
+	tags = set(["cache"])
+	
+	def parse(self, parser):
+		lineno = next(parser.stream).lineno
+		args = [parser.parse_expression()]
+		if parser.stream.skip_if("comma"):
+			args.append(parser.parse_expression())
+		else:
+			args.append(nodes.Const(DEFAULT_TTL))
+		body = parser.parse_statements(["name:endcache"], drop_needle=True)
+		return nodes.CallBlock(self.call_method("_cache", args), [], [], body).set_lineno(lineno)
+	
+	def _cache(self, key, ttl, caller):
+		return Markup(fragments.render(make_key(key), ttl, caller))
+
+
+def make_key(parts):
+	"""Join the parts of a cache key into a string."""
+	if isinstance(parts, (list, tuple)):
+		parts = ":".join(unicode(p) for p in parts)
+	return unicode(parts).encode("utf-8")
+
+
+# These are used within the module.
+class _Call(object):
+	"""A call in flight of a SingleFlight."""
+	
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
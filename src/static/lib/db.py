@@ -1,17 +1,72 @@
 import re
 import cgi
+import math
+import random
+import datetime
+import threading
 
+from google.appengine.api import memcache, users
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import ndb
 
+from lib import cache
+
 
 EMAIL_RE = r'.+@.+\..+'
 
+# Seconds a model's count stays in memcache before being recomputed.
+COUNT_CACHE_TIME = 300
+
+# Maximum number of matches of a search that are ranked.
+SEARCH_LIMIT = 1000
+
+# Words of the searchable fields, as they're indexed.
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Number of changes of a model that prune_changes() keeps by default.
+CHANGES_KEPT = 10000
+
+# Seconds the results of a query stay in memcache (see cache_queries).
+QUERY_CACHE_TIME = 3600
+
+# Seconds after a write to a model during which the results of its
+# queries aren't cached: non-ancestor queries are eventually consistent,
+# so they may not include the write yet.
+QUERY_CACHE_DELAY = 5
+
+# Bytes of encoded entities that each instance keeps in its query cache.
+QUERY_CACHE_SIZE = 8 * 1024 * 1024
+
 
 class Model(ndb.Model):
 	"""Custom Model class."""
 	
 	form = None 		# Link to form class
 	
+	# Set to True to keep a count of the model's entities (see count()).
+	counted = False
+	
+	# Number of entities the count is split into. More shards allow
+	# more entities to be created or destroyed at the same time.
+	count_shards = 20
+	
+	# Name of a property that changes whenever an entity is saved, like
+	# date_time(auto_now=True), to use in cache_key(). Without one, the
+	# model's generation is used.
+	version_property = None
+	
+	# Names of the properties to index for search(), or a dict of their
+	# names and weights (e.g. {"name": 3, "description": 1}).
+	searchable = ()
+	
+	# Set to True to record the changes made with save() and destroy()
+	# in a log that clients can follow (see changes()).
+	feed = False
+	
+	# Set to True to cache the results of all() and fetch() until an
+	# entity of the model is saved or destroyed (see generation()).
+	cache_queries = False
+	
 	def __init__(self, validate=False, *a, **kw):
 		
 		form = self.form
@@ -49,38 +104,467 @@ class Model(ndb.Model):
 	def create(cls, **properties):
 		"""Create and save an instance from this model."""
 		entity = cls(**properties)
-		entity.put()
+		entity.save()
+		return entity
+	
+	@classmethod
+	def count(cls):
+		"""Get the number of entities of the model.
+		Only available if the model is counted.
+		"""
+		assert cls.counted, "%s is not counted" % cls.__name__
+		return cls._counter().get()
+	
+	@classmethod
+	def recount(cls):
+		"""Count the model's entities again, e.g. after entities were
+		written without save() (like in a bulk import)."""
+		cls._counter().reset(cls.query().count())
 	
 	@classmethod
 	def find(cls, id_):
 		"""Fetch the entity with the specified id, otherwise return None."""
 		return ndb.Key(cls, int(id_)).get()
 	
+	@classmethod
+	def generation(cls):
+		"""Get a number that changes whenever an entity of the model is
+		saved or destroyed (with save() and destroy()). Use it in cache
+		keys of things derived from many entities, like lists."""
+		return generation(cls._get_kind())
+	
+	def cache_key(self):
+		"""Get a key for caching things derived from the entity, which
+		changes whenever it's saved."""
+		if self.version_property:
+			version = _serialize(getattr(self, self.version_property))
+		else:
+			version = self.generation()
+		return "%s:%s:%s" % (self._get_kind(), self.key.id(), version)
+	
+	def save(self):
+		"""Save the entity to the datastore.
+		
+		Unlike put(), this updates the model's count when a new entity
+		is saved and records the change in the model's feed, in the same
+		transaction, and changes its generation. Whether the entity is
+		new is checked in the transaction, so entities created with an
+		explicit id are counted too. Inside another transaction (which
+		must be cross-group), this joins it.
+		
+		"""
+		if self.counted or self.feed:
+			counter = self._counter()
+			def txn():
+				new = self.key is None or self.key.id() is None or self.key.get() is None
+				if self.counted and new:
+					counter.increment(1)
+					ndb.get_context().call_on_commit(lambda: counter.cache_increment(1))
+				key = self.put()
+				if self.feed:
+					record_change(self, "create" if new else "update")
+				return key
+			key = ndb.transaction(txn, xg=True, propagation=ndb.TransactionOptions.ALLOWED)
+		else:
+			key = self.put()
+		
+		if self.searchable:
+			SearchDoc.build(self).put()
+		_on_commit(lambda: next_generation(self._get_kind()))
+		return key
+	
 	def destroy(self):
-		"""Remove the entity from the datastore."""
-		self.key.delete()
+		"""Remove the entity from the datastore.
+		
+		The count and the feed are only updated if the entity still
+		exists, so deleting it twice doesn't count twice. Like save(),
+		this joins the current transaction, if there's one.
+		
+		"""
+		if self.counted or self.feed:
+			counter = self._counter()
+			def txn():
+				if self.key.get() is None:
+					return
+				if self.counted:
+					counter.increment(-1)
+					ndb.get_context().call_on_commit(lambda: counter.cache_increment(-1))
+				self.key.delete()
+				if self.feed:
+					record_change(self, "destroy")
+			ndb.transaction(txn, xg=True, propagation=ndb.TransactionOptions.ALLOWED)
+		else:
+			self.key.delete()
+		
+		if self.searchable:
+			SearchDoc.key_for(self.key).delete()
+		_on_commit(lambda: next_generation(self._get_kind()))
+	
+	@classmethod
+	def link_base(cls):
+		"""Return the path of the model's controller, e.g. "/items".
+		It's set when the controller is routed, or found from the
+		module's name, once per class."""
+		try:
+			return _link_bases[cls]
+		except KeyError:
+			return _link_bases.setdefault(cls, '/%ss' % _lowercase(cls.__module__[7:]))
 	
 	def link(self):
 		"""Return the link for the entity's show page."""
-		return '/%ss/%s' % (_lowercase(self.__module__[7:]), self.key.id())
+		return '%s/%s' % (self.link_base(), self.key.id())
 	
 	def edit_link(self):
 		"""Return the link for the entity's edit page."""
-		return self.link() + '/edit'
+		return '%s/%s/edit' % (self.link_base(), self.key.id())
 	
 	def get_id(self):
 		"""Shortcut for key.id()"""
 		return str(self.key.id())
 	
+	@classmethod
+	def search(cls, query, limit=20, offset=0):
+		"""Find the entities whose searchable properties have all the
+		words of a query, best matches first.
+		
+		Returns a page of the entities and the total number of matches
+		(at most SEARCH_LIMIT are ranked).
+		
+		"""
+		words = set(tokenize(query))
+		if not words:
+			return [], 0
+		
+		q = SearchDoc.query(SearchDoc.kind == cls._get_kind())
+		for word in words:
+			q = q.filter(SearchDoc.words == word)
+		docs = q.fetch(SEARCH_LIMIT)
+		docs.sort(key=lambda doc: doc.score(words), reverse=True)
+		
+		keys = [doc.key.parent() for doc in docs[offset:offset + limit]]
+		return filter(None, ndb.get_multi(keys)), len(docs)
+	
+	@classmethod
+	def reindex(cls, batch_size=500):
+		"""Index every entity of the model for search(), e.g. after
+		entities were written without save()."""
+		cursor, more = None, True
+		while more:
+			entities, cursor, more = cls.query().fetch_page(batch_size, start_cursor=cursor)
+			ndb.put_multi([SearchDoc.build(entity) for entity in entities])
+	
+	@classmethod
+	def changes(cls, since=0, limit=100):
+		"""Get the changes recorded after the given sequence number, in
+		order. Only available if the model has a feed."""
+		assert cls.feed, "%s has no feed" % cls.__name__
+		log_key = ndb.Key(ChangeLog, cls._get_kind())
+		q = ChangeEntry.query(ancestor=log_key)
+		if since:
+			q = q.filter(ChangeEntry.key > ndb.Key(ChangeEntry, since, parent=log_key))
+		return q.order(ChangeEntry.key).fetch(limit)
+	
+	@classmethod
+	def prune_changes(cls, keep=CHANGES_KEPT):
+		"""Delete all but the given number of most recent changes."""
+		log_key = ndb.Key(ChangeLog, cls._get_kind())
+		oldest = last_change(cls._get_kind()) - keep
+		if oldest > 0:
+			q = ChangeEntry.query(ancestor=log_key).filter(
+				ChangeEntry.key <= ndb.Key(ChangeEntry, oldest, parent=log_key))
+			ndb.delete_multi(q.fetch(keys_only=True))
+	
+	@classmethod
+	def fetch_refs(cls, entities, *names):
+		"""Fetch the entities referenced by key properties of a list of
+		entities, all in a single get_multi.
+		
+		This avoids fetching them one at a time when rendering a list.
+		Use ref() to get them afterwards.
+		
+		"""
+		keys = set()
+		for entity in entities:
+			for name in names:
+				value = getattr(entity, name)
+				keys.update(value if isinstance(value, list) else filter(None, [value]))
+		keys = list(keys)
+		found = dict(zip(keys, ndb.get_multi(keys)))
+		
+		for entity in entities:
+			refs = entity.__dict__.setdefault("_refs", {})
+			for name in names:
+				value = getattr(entity, name)
+				if isinstance(value, list):
+					refs[name] = [found[k] for k in value]
+				else:
+					refs[name] = found.get(value)
+	
+	def ref(self, name):
+		"""Get the entity (or list of entities) referenced by a key
+		property. Uses the ones fetched by fetch_refs(), if any."""
+		refs = self.__dict__.get("_refs", {})
+		if name in refs:
+			return refs[name]
+		value = getattr(self, name)
+		if isinstance(value, list):
+			return ndb.get_multi(value)
+		return value.get() if value else None
+	
+	def serialize(self):
+		"""Return the entity's id and properties as JSON-compatible values.
+		Dates and times become ISO 8601 strings and keys become urlsafe
+		strings.
+		"""
+		data = dict((name, _serialize(value)) for name, value in self.to_dict().items())
+		data["id"] = self.key.id() if self.key else None
+		return data
+	
 	@classmethod
 	def fetch(cls, n):
 		"""Get the given number of the model's entities from the datastore."""
-		return cls.query().fetch(quantity)
+		return cls.cached_query("fetch:%d" % n, lambda: cls.query().fetch(n))
 	
 	@classmethod
 	def all(cls):
 		"""Get all the model's entities from the datastore."""
-		return cls.query().fetch()
+		return cls.cached_query("all", lambda: cls.query().fetch())
+	
+	@classmethod
+	def cached_query(cls, name, run):
+		"""Get the results of a query from the query cache, or run it.
+		
+		The name identifies the query and its parameters. Results are
+		cached with the model's generation, so they're used until an
+		entity is saved or destroyed, but not for QUERY_CACHE_DELAY
+		seconds after a write, when they may not include it yet. They're
+		kept in an in-process LRU cache and in memcache, as encoded
+		entities (so each request gets its own copies). Queries run every
+		time unless the model sets cache_queries.
+		
+		"""
+		if not cls.cache_queries:
+			return run()
+		
+		kind = cls._get_kind()
+		cache_key = "query:%s:%s:%s" % (kind, generation(kind), name)
+		encoded = _query_cache.get(cache_key)
+		if encoded is None:
+			encoded = memcache.get(cache_key)
+			if encoded is not None:
+				_query_cache.set(cache_key, encoded, QUERY_CACHE_TIME)
+		if encoded is not None:
+			return [_adapter.pb_to_entity(entity_pb.EntityProto(pb)) for pb in encoded]
+		
+		entities = run()
+		if _written_recently(kind):
+			return entities
+		encoded = [_adapter.entity_to_pb(e).Encode() for e in entities]
+		_query_cache.set(cache_key, encoded, QUERY_CACHE_TIME)
+		try:
+			memcache.set(cache_key, encoded, QUERY_CACHE_TIME)
+		except ValueError: pass		# Too large for memcache
+		return entities
+	
+	@classmethod
+	def _counter(cls):
+		return ShardedCounter(cls._get_kind(), cls.count_shards)
+
+
+class CounterShard(ndb.Model):
+	"""Part of a sharded counter."""
+	count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class ShardedCounter(object):
+	"""Counter split across several entities.
+	
+	Each update only touches a random shard, so many of them can
+	happen at the same time. The total is cached in memcache, which
+	makes reading it a single lookup most of the time.
+	
+	"""
+	
+	def __init__(self, name, shards=20):
+		self.name = name
+		self.shards = shards
+		self.cache_key = "count:%s" % name
+	
+	def get(self):
+		"""Get the counter's total."""
+		total = memcache.get(self.cache_key)
+		if total is None:
+			keys = [ndb.Key(CounterShard, "%s:%d" % (self.name, i)) for i in range(self.shards)]
+			total = sum(shard.count for shard in ndb.get_multi(keys) if shard)
+			memcache.add(self.cache_key, total, COUNT_CACHE_TIME)
+		return total
+	
+	def increment(self, delta=1):
+		"""Add to the counter. Call this inside the transaction that
+		makes the change, then cache_increment() once it's committed."""
+		key = ndb.Key(CounterShard, "%s:%d" % (self.name, random.randint(0, self.shards - 1)))
+		shard = key.get() or CounterShard(key=key)
+		shard.count += delta
+		shard.put()
+	
+	def reset(self, total):
+		"""Set the counter's total."""
+		keys = [ndb.Key(CounterShard, "%s:%d" % (self.name, i)) for i in range(self.shards)]
+		ndb.put_multi([CounterShard(key=k, count=total if i == 0 else 0) for i, k in enumerate(keys)])
+		memcache.set(self.cache_key, total, COUNT_CACHE_TIME)
+	
+	def cache_increment(self, delta=1):
+		"""Update the cached total, if there's one."""
+		if delta > 0:
+			memcache.incr(self.cache_key, delta)
+		elif delta < 0:
+			memcache.decr(self.cache_key, -delta)
+
+
+def set_link_base(model, path):
+	"""Set the path of a model's controller, used by link() and
+	edit_link(). Called by webapp_enhanced.route()."""
+	_link_bases[model] = path
+
+
+def generation(kind):
+	"""Get the generation of a kind of entities (see Model.generation()).
+	While the thread remembers generations, it's read once."""
+	remembered = getattr(_local, "generations", None)
+	if remembered is not None and kind in remembered:
+		return remembered[kind]
+	
+	cache_key = "generation:%s" % kind
+	value = memcache.get(cache_key)
+	if value is None:
+		memcache.add(cache_key, _first_generation())
+		value = memcache.get(cache_key)
+	if remembered is not None:
+		remembered[kind] = value
+	return value
+
+def next_generation(kind):
+	"""Change the generation of a kind of entities, e.g. after writing
+	entities without save()."""
+	memcache.incr("generation:%s" % kind, initial_value=_first_generation())
+	if getattr(ndb.Model._kind_map.get(kind), "cache_queries", False):
+		memcache.set("written:%s" % kind, _first_generation(), QUERY_CACHE_DELAY + 1)
+	remembered = getattr(_local, "generations", None)
+	if remembered is not None:
+		remembered.pop(kind, None)
+
+def remember_generations(on=True):
+	"""Make generation() read each kind's generation from memcache once
+	in this thread, until called with False. BaseController does this
+	for each request, so a page with many cache_key()s makes one call
+	per kind instead of one per entity."""
+	_local.generations = {} if on else None
+
+
+class SearchDoc(ndb.Model):
+	"""The searchable words of an entity, stored as its child.
+	
+	The datastore's index of the words property works as an inverted
+	index: search() queries it with one filter per word.
+	
+	"""
+	kind = ndb.StringProperty()
+	words = ndb.StringProperty(repeated=True)
+	weights = ndb.JsonProperty()		# Weighted number of times each word appears
+	length = ndb.IntegerProperty(default=0, indexed=False)
+	
+	@staticmethod
+	def key_for(entity_key):
+		return ndb.Key(SearchDoc, "search", parent=entity_key)
+	
+	@classmethod
+	def build(cls, entity):
+		"""Create the document of an entity from its searchable properties."""
+		fields = entity.searchable
+		if not isinstance(fields, dict):
+			fields = dict((name, 1) for name in fields)
+		
+		weights, length = {}, 0
+		for name, weight in fields.items():
+			value = getattr(entity, name)
+			for word in tokenize(" ".join(map(unicode, value)) if isinstance(value, list) else value):
+				weights[word] = weights.get(word, 0) + weight
+				length += 1
+		return cls(key=cls.key_for(entity.key), kind=entity._get_kind(),
+				   words=sorted(weights), weights=weights, length=length)
+	
+	def score(self, words):
+		"""Rank the document for the words of a query. Words that appear
+		more often (or in heavier fields) in shorter documents rank higher."""
+		return sum(self.weights.get(w, 0) for w in words) / math.sqrt(self.length or 1)
+
+
+class ChangeLog(ndb.Model):
+	"""Parent of the changes of a kind, which holds the last
+	sequence number. Its id is the kind."""
+	seq = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class ChangeEntry(ndb.Model):
+	"""A change made to an entity. Its id is its sequence number."""
+	action = ndb.StringProperty(indexed=False)		# "create", "update" or "destroy"
+	target = ndb.KeyProperty(indexed=False)
+	data = ndb.JsonProperty()		# The entity, serialized; None when destroyed
+	created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+	
+	def serialize(self):
+		return {
+			"seq": self.key.id(),
+			"action": self.action,
+			"id": self.target.id(),
+			"data": self.data,
+			"time": self.created.isoformat(),
+		}
+
+
+def record_change(entity, action):
+	"""Append a change to the log of the entity's kind.
+	
+	Must be called in the (cross-group) transaction that makes the
+	change, so the change and its entry are saved together or not at
+	all. The sequence number comes from the kind's ChangeLog, so
+	changes are strictly ordered; this also means that a kind with a
+	feed takes about one write per second, like any entity group. Once
+	committed, the last number is kept in memcache for last_change().
+	
+	"""
+	assert ndb.in_transaction(), "record_change() must be called in a transaction"
+	kind = entity._get_kind()
+	log_key = ndb.Key(ChangeLog, kind)
+	data = entity.serialize() if action != "destroy" else None
+	
+	log = log_key.get() or ChangeLog(key=log_key)
+	log.seq += 1
+	ndb.put_multi([log, ChangeEntry(parent=log_key, id=log.seq, action=action,
+									target=entity.key, data=data)])
+	seq = log.seq
+	ndb.get_context().call_on_commit(lambda: memcache.set("changes:%s" % kind, seq))
+	return seq
+
+def last_change(kind):
+	"""Get the sequence number of the last change of a kind.
+	Read from memcache when possible, so it's cheap to poll.
+	"""
+	seq = memcache.get("changes:%s" % kind)
+	if seq is None:
+		log = ndb.Key(ChangeLog, kind).get()
+		seq = log.seq if log else 0
+		memcache.add("changes:%s" % kind, seq)
+	return seq
+
+
+def tokenize(text):
+	"""Split a text into the lowercase words that are indexed."""
+	if not text:
+		return []
+	if not isinstance(text, unicode):
+		text = str(text).decode("utf-8", "replace")
+	return [w for w in WORD_RE.findall(text.lower()) if len(w) > 1]
 
 
 class BaseValidator(object):
@@ -241,7 +725,50 @@ json = ndb.JsonProperty
 pickle = ndb.PickleProperty
 
 
-# This is used within the module.
+# These are used within the module.
+_query_cache = cache.LRUCache(QUERY_CACHE_SIZE, weigh=lambda encoded: sum(len(pb) for pb in encoded))
+_adapter = ndb.ModelAdapter()
+_link_bases = {}		# Paths of the models' controllers; see Model.link_base()
+_local = threading.local()		# Generations remembered by the request; see remember_generations()
+
+def _serialize(value):
+	"""Convert a property value to a JSON-compatible value."""
+	if isinstance(value, (list, tuple)):
+		return [_serialize(v) for v in value]
+	if isinstance(value, dict):
+		return dict((k, _serialize(v)) for k, v in value.items())
+	if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+		return value.isoformat()
+	if isinstance(value, ndb.Key):
+		return value.urlsafe()
+	if isinstance(value, ndb.GeoPt):
+		return "%s,%s" % (value.lat, value.lon)
+	if isinstance(value, users.User):
+		return value.email()
+	if isinstance(value, ndb.BlobKey):
+		return str(value)
+	return value
+
+def _on_commit(fn):
+	"""Call fn once the current transaction is committed, or now if
+	there's none."""
+	if ndb.in_transaction():
+		ndb.get_context().call_on_commit(fn)
+	else:
+		fn()
+
+def _written_recently(kind):
+	"""Whether a kind of entities was written in the last
+	QUERY_CACHE_DELAY seconds (see next_generation())."""
+	written = memcache.get("written:%s" % kind)
+	return written is not None and _first_generation() - written < QUERY_CACHE_DELAY * 1000
+
+def _first_generation():
+	"""Start generations from the current time in milliseconds, so that
+	they don't repeat when memcache loses them."""
+	delta = datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)
+	return int(delta.total_seconds() * 1000)
+
 def _lowercase(s):
 	"""Convert class-like names to varliable-like names."""
 	s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', s)
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import threading
+import itertools
+import contextlib
+import collections
+
+from google.appengine.api import users
+
+
+class Profiler(object):
+	"""Sampling profiler for controllers.
+	
+	One in every N requests (and requests sent by admins with the
+	profiling header) runs under a tracer that charges the time spent
+	to the current call stack. Stacks are aggregated per controller
+	class and mode, and can be exported in the collapsed format used
+	by flame graph tools (flamegraph.pl, speedscope, ...).
+	
+	Requests that aren't sampled only pay for a counter and a header
+	lookup.
+	
+	"""
+	
+	def __init__(self, every=100, header="X-Profile"):
+		self.every = every
+		self.header = header
+		self._counter = itertools.count(1)
+		self._lock = threading.Lock()
+		self._stacks = {}
+		self._samples = collections.defaultdict(int)
+	
+	def should_sample(self, request):
+		"""Determine whether the request should be profiled."""
+		if self.header and self.header in request.headers:
+			return users.is_current_user_admin()
+		return bool(self.every) and next(self._counter) % self.every == 0
+	
+	@contextlib.contextmanager
+	def profile(self, key):
+		"""Profile the block, adding its stacks to the given key."""
+		tracer = StackTracer(key)
+		tracer.start()
+		try:
+			yield
+		finally:
+			tracer.stop()
+			self.add(key, tracer.stacks)
+	
+	def add(self, key, stacks):
+		"""Add the stacks of a profiled request."""
+		with self._lock:
+			totals = self._stacks.setdefault(key, collections.defaultdict(float))
+			for stack, seconds in stacks.items():
+				totals[stack] += seconds
+			self._samples[key] += 1
+	
+	def summary(self):
+		"""Return the number of samples and the profiled time
+		(in milliseconds) of every key."""
+		with self._lock:
+			return dict((key, {
+				"samples": self._samples[key],
+				"time": round(sum(stacks.values()) * 1000, 2),
+			}) for key, stacks in self._stacks.items())
+	
+	def collapsed(self, key=None):
+		"""Return the collapsed stacks, one per line, with their time
+		in microseconds. If a key is given, only its stacks are used."""
+		with self._lock:
+			items = [(k, dict(s)) for k, s in self._stacks.items()
+					 if key is None or k == key]
+		lines = []
+		for _, stacks in sorted(items):
+			for stack, seconds in sorted(stacks.items()):
+				micros = int(seconds * 1000000)
+				if micros:
+					lines.append("%s %d" % (stack, micros))
+		return '\n'.join(lines) + '\n'
+	
+	def reset(self):
+		"""Forget every profiled request."""
+		with self._lock:
+			self._stacks.clear()
+			self._samples.clear()
+
+
+class StackTracer(object):
+	"""Record the time spent in every call stack of the current thread.
+	
+	Uses sys.setprofile(), so the time between two events (calls and
+	returns, including those of built-in functions) is charged to the
+	stack that was running. Stacks are strings of frames joined by
+	semicolons, rooted at the given name.
+	
+	"""
+	
+	def __init__(self, root):
+		self.stacks = collections.defaultdict(float)
+		self._keys = [root]
+		self._last = None
+	
+	def start(self):
+		self._last = time.time()
+		sys.setprofile(self._event)
+	
+	def stop(self):
+		sys.setprofile(None)
+		self._charge()
+	
+	def _charge(self):
+		now = time.time()
+		self.stacks[self._keys[-1]] += now - self._last
+		self._last = now
+	
+	def _event(self, frame, event, arg):
+		self._charge()
+		if event == 'call':
+			self._keys.append(self._keys[-1] + ';' + _frame_label(frame))
+		elif event == 'c_call':
+			self._keys.append(self._keys[-1] + ';' + getattr(arg, '__name__', '?'))
+		elif len(self._keys) > 1:
+			self._keys.pop()		# 'return', 'c_return' and 'c_exception'
+
+
+# This is used within the module.
+def _frame_label(frame):
+	"""Name a frame as function (file:line)."""
+	code = frame.f_code
+	return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+						   code.co_firstlineno)
@@ -0,0 +1,146 @@
+import json
+import struct
+
+from lib.xml import dicttoxml
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+
+class Serializer(object):
+	"""A format that controllers can render data structures in."""
+	
+	def __init__(self, extension, content_type, dumps):
+		self.extension = extension
+		self.content_type = content_type
+		self.dumps = dumps
+
+
+# Registered formats, by extension and by content type.
+_by_extension = {}
+_by_content_type = {}
+
+def register(extension, content_type, dumps):
+	"""Add a format, or replace the one with the same extension.
+	dumps takes a data structure and returns a string.
+	"""
+	serializer = Serializer(extension, content_type, dumps)
+	_by_extension[extension] = serializer
+	_by_content_type[content_type] = serializer
+	return serializer
+
+def find(extension=None, accept=None):
+	"""Get the format for a file extension, or else the first format
+	of an Accept header that's registered. Returns None if neither
+	is registered.
+	"""
+	if extension:
+		return _by_extension.get(extension)
+	for content_type in _parse_accept(accept or ""):
+		if content_type in _by_content_type:
+			return _by_content_type[content_type]
+
+
+def pack(data):
+	"""Encode a data structure as MessagePack.
+	Uses the msgpack package if it's installed.
+	"""
+	if msgpack is not None:
+		return msgpack.packb(data, use_bin_type=False)
+	chunks = []
+	_pack(data, chunks.append)
+	return "".join(chunks)
+
+
+register("json", "application/json", json.dumps)
+register("xml", "application/xml", dicttoxml.dicttoxml)
+register("msgpack", "application/x-msgpack", pack)
+
+
+# These are used within the module.
+def _parse_accept(header):
+	"""Get the content types of an Accept header, preferred first."""
+	types = []
+	for i, part in enumerate(header.split(",")):
+		params = part.strip().split(";")
+		quality = 1.0
+		for param in params[1:]:
+			name, _, value = param.strip().partition("=")
+			if name == "q":
+				try:
+					quality = float(value)
+				except ValueError: pass
+		types.append((-quality, i, params[0].strip().lower()))
+	return [t for _, _, t in sorted(types) if t]
+
+def _pack(obj, write):
+	"""Pure-Python MessagePack encoder for JSON-like data.
+	Strings are raw, without the str 8 type of the newer spec, as the
+	msgpack package writes them with use_bin_type=False.
+	"""
+	if obj is None:
+		write("\xc0")
+	elif obj is True:
+		write("\xc3")
+	elif obj is False:
+		write("\xc2")
+	elif isinstance(obj, (int, long)):
+		if 0 <= obj < 0x80:
+			write(struct.pack("B", obj))
+		elif -0x20 <= obj < 0:
+			write(struct.pack("b", obj))
+		elif 0 <= obj <= 0xff:
+			write(struct.pack(">BB", 0xcc, obj))
+		elif 0 <= obj <= 0xffff:
+			write(struct.pack(">BH", 0xcd, obj))
+		elif 0 <= obj <= 0xffffffff:
+			write(struct.pack(">BI", 0xce, obj))
+		elif 0 <= obj <= 0xffffffffffffffff:
+			write(struct.pack(">BQ", 0xcf, obj))
+		elif obj > 0:
+			raise ValueError("integer out of range for MessagePack: %d" % obj)
+		elif -0x80 <= obj:
+			write(struct.pack(">Bb", 0xd0, obj))
+		elif -0x8000 <= obj:
+			write(struct.pack(">Bh", 0xd1, obj))
+		elif -0x80000000 <= obj:
+			write(struct.pack(">Bi", 0xd2, obj))
+		elif -0x8000000000000000 <= obj:
+			write(struct.pack(">Bq", 0xd3, obj))
+		else:
+			raise ValueError("integer out of range for MessagePack: %d" % obj)
+	elif isinstance(obj, float):
+		write(struct.pack(">Bd", 0xcb, obj))
+	elif isinstance(obj, basestring):
+		if isinstance(obj, unicode):
+			obj = obj.encode("utf-8")
+		n = len(obj)
+		if n < 32:
+			write(struct.pack("B", 0xa0 | n))
+		elif n <= 0xffff:
+			write(struct.pack(">BH", 0xda, n))
+		else:
+			write(struct.pack(">BI", 0xdb, n))
+		write(obj)
+	elif isinstance(obj, (list, tuple)):
+		_pack_header(len(obj), 0x90, 0xdc, write)
+		for item in obj:
+			_pack(item, write)
+	elif isinstance(obj, dict):
+		_pack_header(len(obj), 0x80, 0xde, write)
+		for key, value in obj.iteritems():
+			_pack(key, write)
+			_pack(value, write)
+	else:
+		raise TypeError("can't encode %r as MessagePack" % obj)
+
+def _pack_header(n, fix, code, write):
+	"""Write the header of an array or map of n items."""
+	if n < 16:
+		write(struct.pack("B", fix | n))
+	elif n <= 0xffff:
+		write(struct.pack(">BH", code, n))
+	else:
+		write(struct.pack(">BI", code + 1, n))
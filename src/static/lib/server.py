@@ -2,21 +2,54 @@ import os
 import re
 import cgi
 import json
+import time
 import urllib
 import logging
+import threading
+import pkgutil
+import calendar
 import importlib
+import email.utils
 
 import webapp2
 import jinja2
 
-from lib.xml import dicttoxml as xml
+from lib import db, cache, stats, profiler, tasks, serializers
 
+from google.appengine.api import users
 from google.appengine.ext import ndb, blobstore
+from google.appengine.ext.webapp import blobstore_handlers
 
 
 # Jinja2 variables
 template_dir = os.path.join(os.path.dirname(__file__), '..', "views")
-jinja_env    = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir))
+
+
+def url_for(name, *a, **query):
+	"""Build the path of a route named by webapp_enhanced.route().
+	
+	Positional arguments fill the route's groups (e.g. the id of a
+	show page), and keyword arguments become the query string:
+	url_for("item_show", 4, page=2) gives "/items/4?page=2".
+	
+	"""
+	path = _reverse_routes[name] % a
+	if query:
+		path += '?' + urllib.urlencode(query)
+	return path
+
+def make_jinja_env(**kw):
+	"""Create a Jinja2 environment for the views, with the {% cache %}
+	tag and the generation() and url_for() functions (see lib.cache and
+	lib.db)."""
+	kw["extensions"] = [cache.FragmentCacheExtension] + list(kw.get("extensions", []))
+	kw.setdefault("cache_size", -1)		# Keep every compiled template (see WarmupController)
+	env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), **kw)
+	env.globals["generation"] = db.generation
+	env.globals["url_for"] = url_for
+	return env
+
+jinja_env = make_jinja_env()
 
 
 def render_str(template, **params):
@@ -43,10 +76,7 @@ class Request(webapp2.Request):
 	
 	def get_cookies(self):
 		"""Get a list with every existing cookie."""
-		cookies = []
-		for i in self.cookies.items():
-			cookies.append((i[0], i[1]))
-		return cookies
+		return self.cookies.items()
 	
 	def get_extension(self):
 		"""If the current path has one, get the file extension."""
@@ -70,7 +100,8 @@ class Response(webapp2.Response):
 	
 	def render(self, filename, **params):
 		"""Render and display a template."""
-		html = render_str(filename, ** params)
+		with stats.timed("render"):
+			html = render_str(filename, ** params)
 		self.out.write(html)
 	
 	def set_content(self, t):
@@ -101,10 +132,77 @@ class webapp_enhanced(webapp2.WSGIApplication):
 		
 		"""
 		self._controller_map = []
+		self._stats = False
+		self.profiler = None
+		self.batch_limit = 0
+		self.single_flight = cache.SingleFlight()		# Used by controllers with coalesce = True
+		self.warmup_hooks = []
+		self.warmup_report = None
+	
+	def __call__(self, environ, start_response):
+		"""Handle a WSGI request, measuring it if stats are enabled."""
+		if not self._stats:
+			return super(webapp_enhanced, self).__call__(environ, start_response)
+		
+		stats.begin(environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"))
+		try:
+			return super(webapp_enhanced, self).__call__(environ, start_response)
+		finally:
+			stats.finish()
 	
 	def start(self, **kw):
 		"""Grab the controller map and start the application."""
+		self.add_route('/_ah/warmup', WarmupController)
 		super(webapp_enhanced, self).__init__(self._controller_map, **kw)
+		if self._stats:
+			self.router.set_matcher(_timed_matcher)
+	
+	def enable_stats(self, path=None):
+		"""Record the timings and datastore RPCs of every request.
+		
+		Each response gets a Server-Timing header, each request is
+		logged as a "stats" line, and p50/p95 latencies are kept per
+		route. If a path is given, admins can see them there as JSON.
+		
+		NOTE: call this before start().
+		
+		"""
+		self._stats = True
+		stats.install_hooks()
+		if path:
+			self.add_route(path, StatsController)
+	
+	def enable_profiler(self, every=100, header="X-Profile", path=None):
+		"""Profile one in every given number of requests.
+		
+		Requests from admins that have the given header are always
+		profiled. The profiled stacks are grouped by controller class,
+		method and mode; if a path is given, admins can download them
+		there in the collapsed format used to draw flame graphs.
+		
+		"""
+		self.profiler = profiler.Profiler(every, header)
+		if path:
+			self.add_route(path, ProfileController)
+	
+	def on_warmup(self, hook):
+		"""Add a function to call when the instance is warmed up, e.g. to
+		fill caches. It's called with the app. Can be used as a decorator."""
+		self.warmup_hooks.append(hook)
+		return hook
+	
+	def enable_batch(self, path="/_batch", limit=20):
+		"""Answer many GET requests in a single one.
+		
+		The requests are dispatched to their controllers in-process and
+		their responses are returned together as JSON. See the
+		BatchController class for the format.
+		
+		NOTE: call this before start().
+		
+		"""
+		self.batch_limit = limit
+		self.add_route(path, BatchController)
 	
 	def add_route(self, path_re, controller):
 		"""Add a custom path to the given controller.
@@ -124,12 +222,18 @@ class webapp_enhanced(webapp2.WSGIApplication):
 		Instances of ModelController are given more paths to work
 		accordingly with the class, and, if the default path is not
 		specified, it will be the formatted, pluralized class name.
+		Instances of DownloadController also get a path for each file.
 		
 		NOTE: Normal controllers, as well as index & show pages for
 		      ModelController instances are allowed to have extensions
 		      for XML and JSON compatibility. This may be turned off
 		      by setting the allow_extensions variable to false.
 		
+		The paths are also named for url_for(), after the lowercase
+		class name: "item" for the index page, and "item_new",
+		"item_show" and "item_edit" for model controllers. Entities
+		of a routed model use its controller's path in link().
+		
 		"""
 		for c in controllers:
 			
@@ -139,12 +243,11 @@ class webapp_enhanced(webapp2.WSGIApplication):
 			else:
 				
 				# Set a default path instead:
-				current = '/' + _lowercase(c.__name__)
+				current = '/' + _class_name(c)
 				if c._supports_model: current += 's'
 			
 			# Check for extensions
-			if c.allow_extensions:
-				e = r'(?:\.(.+))?'
+			e = r'(?:\.(.+))?' if c.allow_extensions else ''
 			
 			self.add_route(current + e, c) # Index page
 			
@@ -153,8 +256,28 @@ class webapp_enhanced(webapp2.WSGIApplication):
 				self.add_route(current + r'/new', c) # Create page
 				self.add_route(current + r'/([0-9]+)' + e, c) # Show page
 				self.add_route(current + r'/([0-9]+)/edit', c) # Edit page
+			
+			# Name the paths, unless they're regexps that can't be reversed:
+			path = _reverse_path(current)
+			if path is not None:
+				name = _class_name(c)
+				_reverse_routes[name] = path.replace('%', '%%')
+				if c._supports_model:
+					_reverse_routes[name + '_new'] = _reverse_routes[name] + '/new'
+					_reverse_routes[name + '_show'] = _reverse_routes[name] + '/%s'
+					_reverse_routes[name + '_edit'] = _reverse_routes[name] + '/%s/edit'
+					if c.model is not None:
+						db.set_link_base(c.model, path)
+			
+			# Files of download controllers, with an optional file name:
+			if c._supports_download:
+				self.add_route(current + r'/([^/]+)(?:/[^/]+)?', c)
 	
 	
+	def url_for(self, name, *a, **query):
+		"""Build the path of a named route (see url_for())."""
+		return url_for(name, *a, **query)
+	
 	def set_jinja2_options(self, **kw):
 		"""Change any Jinja2 settings.
 		
@@ -162,7 +285,7 @@ class webapp_enhanced(webapp2.WSGIApplication):
 		
 		"""
 		global jinja_env
-		jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), **kw)
+		jinja_env = make_jinja_env(**kw)
 	
 	def set_views_folder(self, *path):
 		"""Change the default location of the views folder.
@@ -187,10 +310,24 @@ class BaseController(webapp2.RequestHandler):
 	# the extra paths for controllers linked to models.
 	_supports_model = False
 	
+	# The same, for the paths of the files of download controllers.
+	_supports_download = False
+	
 	# This is used to determine whether to add the option of allowing
 	# file extensions in the controller's path.
 	allow_extensions = True
 	
+	# Set to True to share the response of a GET request among the
+	# identical ones that arrive while it's handled, instead of handling
+	# each of them. Only for pages that are the same for every user.
+	coalesce = False
+	
+	# Values of the flags that haven't been set (see get_flag()).
+	_default_flags = {
+		"render": True,
+		"errors": None,
+	}
+	
 	### Methods child classes may override:
 	
 	def index(self):
@@ -211,37 +348,137 @@ class BaseController(webapp2.RequestHandler):
 	
 	def get(self, *a):
 		"""Handle GET requests."""
-		self.init()
+		if not self.get_flag("initialized"):		# Coalesced requests are initialized first
+			with stats.timed("init"): self.init()
 	
 	def post(self, *a):
 		"""Handle POST requests."""
-		self.init()
+		with stats.timed("init"): self.init()
 	
 	def put(self, *a):
 		"""Handle PUT requests."""
-		self.init()
+		with stats.timed("init"): self.init()
 	
 	def delete(self, *a):
 		"""Handle DELETE requests."""
-		self.init()
+		with stats.timed("init"): self.init()
 	
 	
 	### Functions:
 	
+	def dispatch(self):
+		"""Dispatch the request to the RESTful method.
+		When stats are enabled, the timings are added as a header.
+		The calls deferred by the request are sent once it succeeds.
+		"""
+		nested = getattr(self.request, "nested", False)
+		tasks.begin(nested=nested)
+		if not nested:
+			db.remember_generations()
+		failed = True
+		try:
+			if self.coalesce and self.request.method == "GET":
+				rv = self.coalesced_dispatch()
+			else:
+				rv = self.sampled_dispatch()
+			failed = False
+		finally:
+			record = stats.current()
+			if record is not None:
+				self.response.headers["Server-Timing"] = record.header()
+			tasks.flush(discard=failed)		# Also after errors like DeadlineExceededError
+			if not nested:
+				db.remember_generations(False)
+		return rv
+	
+	def sampled_dispatch(self):
+		"""Dispatch the request, profiling it if it's sampled."""
+		p = self.app.profiler
+		if p is not None and p.should_sample(self.request):
+			key = "%s.%s.%s" % (self.__class__.__name__, self.request.method, self.get_mode())
+			with p.profile(key):
+				return super(BaseController, self).dispatch()
+		return super(BaseController, self).dispatch()
+	
+	def coalesced_dispatch(self):
+		"""Dispatch the request, unless an identical one is in flight;
+		in that case, wait for it and copy its response.
+		
+		Each request is initialized and authorized before it waits, since
+		the requests that copy a response don't run the RESTful method.
+		Responses that set cookies or are private aren't copied; the
+		waiting requests are then dispatched on their own.
+		
+		"""
+		key = self.coalesce_key()
+		if key is None:
+			return self.sampled_dispatch()
+		
+		with stats.timed("init"): self.init()
+		self.check_authorized()
+		self.set_flag("initialized", True)
+		self.set_flag("authorized", True)
+		
+		def run():
+			rv = self.sampled_dispatch()
+			r = self.response
+			return rv, r.status, r.headerlist[:], r.body, _shareable(r)
+		
+		start = time.time()
+		(rv, status, headers, body, shareable), shared = self.app.single_flight.do(key, run)
+		if shared and not shareable:
+			return self.sampled_dispatch()
+		if shared:
+			self.response.status = status
+			self.response.headerlist = headers[:]
+			self.response.body = body
+			record = stats.current()
+			if record is not None:
+				record.coalesced = True
+				record.add("coalesced", time.time() - start)
+		return rv
+	
+	def coalesce_key(self):
+		"""Identify the requests that may share a response, or return
+		None if the request mustn't share one.
+		
+		The key includes the Accept header, since render_data() depends
+		on it. Requests with cookies or credentials aren't shared, as
+		their response may depend on the user; override this to include
+		what the response depends on (e.g. a cookie) in the key instead.
+		
+		"""
+		headers = self.request.headers
+		if "Cookie" in headers or "Authorization" in headers:
+			return None
+		return "%s %s %s" % (self.__class__.__name__, self.request.path_qs,
+							 headers.get("Accept", ""))
+	
 	def initialize(self, *a, **kw):
 		"""Default __init__ actions that are handled by this class."""
 		super(BaseController, self).initialize(*a, **kw)
 		
-		# Set the variable-like name for the class:
-		self._name = _lowercase(self.__class__.__name__)
-		
 		self._params = {}		# Arguments that pass to templates
-		
-		# Arguments used only by the server:
-		self._flags = {
-			"render": True,
-			"errors": None,
-		}
+		self._flags = None		# Arguments used only by the server, created when one is set
+	
+	@property
+	def _name(self):
+		"""The variable-like name of the class, computed once per class."""
+		return _class_name(self.__class__)
+	
+	def _template(self, page):
+		"""Get the path of one of the controller's templates."""
+		return _template_path(self.__class__, page)
+	
+	def check_authorized(self):
+		"""Abort with an unauthorized error unless authorized() allows
+		the request. Called by the RESTful methods.
+		"""
+		if self.get_flag("authorized"):
+			return		# Already checked by coalesced_dispatch()
+		with stats.timed("authorized"):
+			allowed = self.authorized()
+		if not allowed: self.abort(401)
 	
 	def deny_access(self):
 		"""Destroy the response and send an unauthorized error.
@@ -250,14 +487,22 @@ class BaseController(webapp2.RequestHandler):
 		"""
 		self.abort(401)
 	
+	def get_mode(self):
+		"""Get the mode string depending on the current page.
+		Simple controllers only have an index page.
+		"""
+		return "index"
+	
 	def get_flag(self, f):
 		"""Get the specified flag's value."""
-		try:
+		if self._flags and f in self._flags:
 			return self._flags[f]
-		except KeyError: pass
+		return self._default_flags.get(f)
 	
 	def set_flag(self, f, value):
 		"""Change a flag's value, or add a new flag."""
+		if self._flags is None:
+			self._flags = {}
 		self._flags[f] = value
 		return value
 	
@@ -267,7 +512,7 @@ class BaseController(webapp2.RequestHandler):
 	
 	def send_data(self, **params):
 		"""Add data that can be used by the views."""
-		self._params = dict(self._params.items() + dict(params).items())
+		self._params.update(params)
 	
 	def send_data_dict(self, d):
 		"""Same as send_data(), but takes in a dictionary
@@ -276,17 +521,39 @@ class BaseController(webapp2.RequestHandler):
 	
 	def render_json(self, d):
 		"""Render and display a data structure as JSON."""
-		self.set_flag("render", False)
-		self.response.headers["Content-Type"] = "application/json"
-		json_txt = json.dumps(d)
-		self.response.out.write(json_txt)
+		self.render_as(serializers.find("json"), d)
 	
 	def render_xml(self, d):
 		"""Render and display a data structure as XML."""
+		self.render_as(serializers.find("xml"), d)
+	
+	def render_msgpack(self, d):
+		"""Render and display a data structure as MessagePack."""
+		self.render_as(serializers.find("msgpack"), d)
+	
+	def render_data(self, d):
+		"""Render and display a data structure in the format given by
+		the path's extension or, without one, by the Accept header
+		(JSON if none of its formats is registered).
+		See lib.serializers to add formats.
+		"""
+		extension = self.request.get_extension()
+		serializer = serializers.find(extension, self.request.headers.get("Accept"))
+		if serializer is None:
+			if extension:
+				self.abort(404)
+			serializer = serializers.find("json")
+		if not extension:
+			self.response.headers["Vary"] = "Accept"		# So caches keep a response per format
+		self.render_as(serializer, d)
+	
+	def render_as(self, serializer, d):
+		"""Render and display a data structure with a serializer."""
 		self.set_flag("render", False)
-		self.response.headers["Content-Type"] = "application/xml"
-		xml_txt = xml.dicttoxml(d)
-		self.response.out.write(xml_txt)
+		self.response.headers["Content-Type"] = serializer.content_type
+		with stats.timed("render"):
+			body = serializer.dumps(d)
+		self.response.out.write(body)
 	
 	def intercept(self, *a):
 		"""Check for a hidden form to perform appropriate method.
@@ -316,14 +583,14 @@ class Controller(BaseController):
 		super(Controller, self).get(*a)
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
 		
 		# Actions from index method:
-		self.index()
+		with stats.timed("index"): self.index()
 		
 		# Check if render flag is on:
-		if self._flags["render"]:
-			self.response.render(self._name + '/index.html', **self._params)
+		if self.get_flag("render"):
+			self.response.render(self._template("index"), **self._params)
 
 
 class ModelController(BaseController):
@@ -338,37 +605,55 @@ class ModelController(BaseController):
 	# Model that the class supports:
 	model = None
 	
+	# Key properties of the model whose entities are fetched (all at
+	# once) for the index and show pages. See Model.fetch_refs().
+	prefetch = ()
+	
+	# Number of results in each page of a search (?q= on the index page).
+	per_page = 20
+	
 	
 	def get(self, *a):
 		"""Handle GET requests."""
 		super(ModelController, self).get(*a)
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
 		
 		# Select mode and use corresponding methods:
 		mode = self.get_mode()
 		if mode == "index":
-			self.get_resources()
-			self.index()
+			query = self.request.get("q")
+			if query and self.model.searchable:
+				resources = self.search_resources(query)
+			else:
+				resources = self.get_resources()
+			if self.prefetch:
+				self.model.fetch_refs(resources, *self.prefetch)
+			self._params["resources"] = self.resources = resources
+			if self.model.counted:
+				self._params["count"] = self.model.count()
+			with stats.timed(mode): self.index()
 		elif mode == "new":
-			self.new()
+			with stats.timed(mode): self.new()
 		elif mode == "show":
-			self.get_resource(list(a)[0])
-			self.show()
+			resource = self.get_resource(list(a)[0])
+			if self.prefetch:
+				self.model.fetch_refs([resource], *self.prefetch)
+			with stats.timed(mode): self.show()
 		elif mode == "edit":
 			self.get_resource(list(a)[0])
-			self.edit()
+			with stats.timed(mode): self.edit()
 		
 		# Check if render flag is on:
-		if self._flags["render"]:
+		if self.get_flag("render"):
 			self.render_appropriate(mode, **self._params)
 	
 	def post(self, *a):
 		BaseController.post(self, *a)
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
 		
 		if self.intercept(*a): return 	# Catches PUT and DELETE methods
 		
@@ -380,8 +665,8 @@ class ModelController(BaseController):
 		
 		try:
 			new_entity = self.model(validate=True, **data)
-			new_entity.put()
-			self.create(new_entity)		# This is called in child classes after default stuff is done.
+			new_entity.save()
+			with stats.timed("create"): self.create(new_entity)		# This is called in child classes after default stuff is done.
 			return self.redirect(new_entity.link())
 		
 		# NOTE: An IOError is raised when validation fails.
@@ -394,7 +679,7 @@ class ModelController(BaseController):
 		BaseController.put(self, *a)
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
 		
 		form = self.model.form
 		assert form is not None
@@ -412,8 +697,8 @@ class ModelController(BaseController):
 						value = validator(value)
 					setattr(resource, name, value)
 				except IOError: pass
-		resource.put()
-		self.update(resource)			# This is the overriden actions after updating the resource.
+		resource.save()
+		with stats.timed("update"): self.update(resource)			# This is the overriden actions after updating the resource.
 		return self.redirect(resource.link())
 	
 	# TO-DO: Refresh the index page; resource still 'appears' after redirect.
@@ -423,16 +708,16 @@ class ModelController(BaseController):
 		"""
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
 		
-		self._flags["render"] = False
+		self.set_flag("render", False)
 		resource_id = self.request.get("_resource_id")
 		resource = self.get_resource(resource_id)
 		if resource:
-			self.destroy(resource)		# Overridable
+			with stats.timed("destroy"): self.destroy(resource)		# Overridable
 			resource.destroy()
 			logging.info("DELETE %r" % resource)
-		self.redirect('/%ss' % self._name)
+		self.redirect(self.model.link_base())
 	
 	def get_mode(self):
 		"""Get the mode string depending on the current page.
@@ -440,6 +725,9 @@ class ModelController(BaseController):
 		appropriate methods and templates.
 		"""
 		path = self.request.path
+		extension = self.request.get_extension()
+		if extension:
+			path = path[:-len(extension) - 1]	# So that index.json is still "index"
 		if path[:-1] == '/' + self._name or path[:-1] == '/' + self._name + 's':
 			return "index"
 		elif re.match(r'([0-9]+)(?:\.(.+))?', path.split('/')[-1]):
@@ -452,16 +740,17 @@ class ModelController(BaseController):
 		
 		# Index page:
 		if mode == "index":
-			resources = self.get_resources()
-			self.response.render(self._name + '/index.html', resources = resources, **params)
+			if "resources" not in params:
+				params["resources"] = self.get_resources()
+			self.response.render(self._template("index"), **params)
 		
 		# Resoucrce page:
 		elif mode == "show":
-			self.response.render(self._name + '/show.html', **params)
+			self.response.render(self._template("show"), **params)
 		
 		# Resource edit page:
 		elif mode == "edit":
-			self.response.render(self._name + '/edit.html', **params)
+			self.response.render(self._template("edit"), **params)
 		
 		# Any other page:
 		else: self.response.render(self._name + '/' + mode + '.html', **params)
@@ -505,9 +794,25 @@ class ModelController(BaseController):
 	
 	def get_resources(self):
 		"""Get the resources from the linked model.
-		Called when displaying index.html.
+		Called when displaying index.html. In a batch, the query may
+		have been started already (see BatchController.prefetch()).
 		"""
+		resources = getattr(self.request, "resources", None)
+		if resources is not None:
+			return resources.get_result()
 		return self.model.all()
+	
+	def search_resources(self, query):
+		"""Get a page of the resources that match a search, best first.
+		Called when displaying index.html with ?q= (and ?page=).
+		"""
+		page = self.request.get("page")
+		page = int(page) if page.isdigit() and int(page) > 0 else 1
+		with stats.timed("search"):
+			resources, total = self.model.search(query, self.per_page, (page - 1) * self.per_page)
+		self.send_data(query = query, page = page, total = total,
+					   pages = -(-total // self.per_page))
+		return resources
 
 
 class AJAXController(BaseController):
@@ -517,10 +822,7 @@ class AJAXController(BaseController):
 	
 	"""
 	
-	def initialize(self, *a, **kw):
-		BaseController.initialize(self, *a, **kw)
-		self._flags["render"] = False
-	
+	_default_flags = dict(BaseController._default_flags, render = False)
 	
 	### Methods child classes may override:
 	
@@ -547,36 +849,533 @@ class AJAXController(BaseController):
 		super(AJAXController, self).get(*a)
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
 		
-		self.GET()
+		with stats.timed("get"): self.GET()
 	
 	def post(self, *a):
 		super(AJAXController, self).post(*a)
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
 		
-		self.POST()
+		with stats.timed("post"): self.POST()
 	
 	def put(self, *a):
 		super(AJAXController, self).put(*a)
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
 		
-		self.PUT()
+		with stats.timed("put"): self.PUT()
 	
 	def delete(self, *a):
 		super(AJAXController, self).delete(*a)
 		
 		# Check for authorization:
-		if not self.authorized(): self.abort(401)
+		self.check_authorized()
+		
+		with stats.timed("delete"): self.DELETE()
+
+
+class StatsController(AJAXController):
+	"""Show the timings of every route as JSON.
+	
+	This controller is routed by webapp_enhanced.enable_stats()
+	and is only available to the app's admins.
+	
+	"""
+	
+	def authorized(self):
+		return users.is_current_user_admin()
+	
+	def GET(self):
+		if self.request.get("reset"):
+			stats.aggregate.reset()
+		self.render_json(stats.aggregate.summary())
+
+
+class ProfileController(AJAXController):
+	"""Export the profiled stacks for flame graphs.
+	
+	This controller is routed by webapp_enhanced.enable_profiler()
+	and is only available to the app's admins. Use ?key= to get the
+	stacks of a single controller and mode, or ?format=json to list
+	the profiled keys.
+	
+	"""
+	
+	def authorized(self):
+		return users.is_current_user_admin()
+	
+	def GET(self):
+		p = self.app.profiler
+		if self.request.get("reset"):
+			p.reset()
+		if self.request.get("format") == "json":
+			return self.render_json(p.summary())
+		self.response.set_content("text/plain")
+		self.response.out.write(p.collapsed(self.request.get("key") or None))
+
+
+class BatchController(AJAXController):
+	"""Answer many GET requests in a single one.
+	
+	This controller is routed by webapp_enhanced.enable_batch(). The
+	paths are given as ?path= parameters, or POSTed as a JSON list.
+	Each one is dispatched to its controller through the router, with
+	the headers of the batch request (so cookies and users still work),
+	and the response is a JSON list of {"path", "status", "body"}
+	objects. JSON bodies are included as values.
+	
+	The entities of the show and edit pages of model controllers in the
+	batch are fetched together before dispatching, so their controllers
+	find them in the ndb cache, and the queries of their index pages
+	are started at the same time, so they run concurrently. Pages are
+	then rendered one after another.
+	
+	"""
+	
+	def GET(self):
+		self.answer(self.request.get_all("path"))
+	
+	def POST(self):
+		try:
+			paths = json.loads(self.request.body)
+		except ValueError:
+			self.abort(400)
+		if not isinstance(paths, list):
+			self.abort(400)
+		self.answer(paths)
+	
+	def answer(self, paths):
+		"""Dispatch the requests and render their responses."""
+		if not paths or len(paths) > self.app.batch_limit:
+			self.abort(400)
+		if any(self.request.path == urllib.splitquery(unicode(p))[0] for p in paths):
+			self.abort(400)		# No batches inside batches
 		
-		self.DELETE()
+		requests = [self.make_request(unicode(path)) for path in paths]
+		with stats.timed("prefetch"):
+			keys = filter(None, [self.prefetch(r) for r in requests])
+			ndb.get_multi(keys)
+		
+		record = stats.current()
+		route = record and record.route
+		responses = [self.dispatch_request(r) for r in requests]
+		if record is not None:
+			record.route = route		# Routing the batched requests changed it
+		self.render_json(responses)
+	
+	def make_request(self, path):
+		"""Create a GET request that shares this request's headers."""
+		environ = dict((k, v) for k, v in self.request.environ.items()
+					   if k.startswith(_SHARED_ENVIRON) and not k.startswith("HTTP_CONTENT_"))
+		request = self.app.request_class.blank(path.encode("utf-8"), environ)
+		request.app = self.app
+		request.nested = True		# Its deferred calls go with the batch's
+		return request
+	
+	def prefetch(self, request):
+		"""Start getting what the page of a model controller needs.
+		
+		Returns the key of the entity of a show or edit page, so they're
+		all fetched at once. The query of an index page is started right
+		away and given to the controller as request.resources (see
+		ModelController.get_resources()), unless its controller gets its
+		resources in another way or they're searched or cached.
+		
+		"""
+		try:
+			route, args, _ = webapp2.Router.default_matcher(self.app.router, request)
+		except webapp2.HTTPException:
+			return None		# Answered by dispatch_request()
+		handler = route.handler
+		if not (isinstance(handler, type) and issubclass(handler, ModelController)):
+			return None
+		if args and args[0] and args[0].isdigit():
+			return ndb.Key(handler.model, int(args[0]))
+		if (len(args) == 1 and not request.get("q") and not handler.model.cache_queries
+				and handler.get_resources.im_func is ModelController.get_resources.im_func):
+			request.resources = handler.model.query().fetch_async()		# An index page
+	
+	def dispatch_request(self, request):
+		"""Dispatch a request to its controller and describe the response."""
+		response = self.app.response_class()
+		try:
+			self.app.router.dispatch(request, response)
+		except webapp2.HTTPException as e:
+			response.status = e.code
+		except Exception:
+			logging.exception("Batched request to %s failed" % request.path_qs)
+			response.status = 500
+		
+		body = response.body
+		if response.content_type == "application/json" and body:
+			body = json.loads(body)
+		else:
+			body = body.decode(response.charset or "utf-8", "replace")
+		return {"path": request.path_qs, "status": response.status_int, "body": body}
+
+
+class WarmupController(AJAXController):
+	"""Prepare a new instance before it gets requests.
+	
+	This controller is routed by webapp_enhanced.start() at
+	/_ah/warmup, where App Engine sends warmup requests (enabled by
+	the warmup inbound service in app.yaml). It imports the routed
+	controllers and the models, compiles every template and calls the
+	app's warmup hooks, then returns what it did and how long it took
+	as JSON. Later requests get the same report.
+	
+	"""
+	
+	def GET(self):
+		with _warmup_lock:
+			if self.app.warmup_report is None:
+				self.app.warmup_report = self.warm_up()
+				logging.info("Warmed up in %.2f s" % self.app.warmup_report["seconds"])
+		self.render_json(self.app.warmup_report)
+	
+	def warm_up(self):
+		"""Do the work and describe it."""
+		start = time.time()
+		report = {"errors": []}
+		
+		def step(name, fn, *a):
+			t = time.time()
+			try:
+				fn(*a)
+			except Exception as e:
+				logging.exception("Warmup step %s failed" % name)
+				report["errors"].append("%s: %s" % (name, e))
+			return round((time.time() - t) * 1000, 2)
+		
+		report["controllers"] = step("controllers", self.import_modules)
+		templates = jinja_env.list_templates()
+		report["templates"] = sum(step(t, jinja_env.get_template, t) for t in templates)
+		report["template_count"] = len(templates)
+		report["hooks"] = dict((h.__name__, step(h.__name__, h, self.app))
+							   for h in self.app.warmup_hooks)
+		report["seconds"] = round(time.time() - start, 3)
+		return report
+	
+	def import_modules(self):
+		"""Import the routed controllers (when given by name) and the models."""
+		for _, controller in self.app._controller_map:
+			if isinstance(controller, basestring):
+				webapp2.import_string(controller)
+		for _, name, _ in pkgutil.iter_modules(['models']):
+			importlib.import_module('models.' + name)
+
+
+class FeedController(BaseController):
+	"""Controller that serves the changes of a model with a feed.
+	
+	Clients send the sequence number of the last change they have as
+	?since= and get the changes that followed it, as JSON:
+	
+	    {"changes": [{"seq", "action", "id", "data", "time"}...], "since": 42}
+	
+	With ?wait=1, the request waits (up to timeout seconds) until there
+	are changes. Clients that accept text/event-stream get them as
+	server-sent events instead; App Engine sends responses all at once,
+	so each response ends after the changes it has, and EventSource
+	reconnects with the last id (a long poll).
+	
+	"""
+	
+	# Model whose changes are served:
+	model = None
+	
+	# Maximum number of changes in a response.
+	limit = 100
+	
+	# Seconds a request waits for changes, and between checks.
+	timeout = 20
+	poll_interval = 1
+	
+	def get(self, *a):
+		"""Handle GET requests."""
+		super(FeedController, self).get(*a)
+		
+		# Check for authorization:
+		self.check_authorized()
+		
+		self.set_flag("render", False)
+		since = self.request.get("since") or self.request.headers.get("Last-Event-ID") or "0"
+		if not since.isdigit():
+			self.abort(400)
+		since = int(since)
+		
+		events = "text/event-stream" in self.request.headers.get("Accept", "")
+		with stats.timed("changes"):
+			if events or self.request.get("wait"):
+				self.wait(since)
+			changes = [c.serialize() for c in self.model.changes(since, self.limit)]
+		if changes:
+			since = changes[-1]["seq"]
+		
+		if events:
+			self.render_events(changes)
+		else:
+			self.render_json({"changes": changes, "since": since})
+	
+	def wait(self, since):
+		"""Wait until there are changes after the given one, or until
+		the timeout. Only memcache is checked meanwhile."""
+		kind = self.model._get_kind()
+		deadline = time.time() + self.timeout
+		while db.last_change(kind) <= since and time.time() < deadline:
+			time.sleep(self.poll_interval)
+	
+	def render_events(self, changes):
+		"""Render the changes as server-sent events."""
+		self.response.headers["Content-Type"] = "text/event-stream"
+		self.response.headers["Cache-Control"] = "no-cache"
+		self.response.out.write("retry: %d\n\n" % (self.poll_interval * 1000))
+		for change in changes:
+			self.response.out.write("id: %d\nevent: %s\ndata: %s\n\n"
+									% (change["seq"], change["action"], json.dumps(change)))
+
+
+class UploadController(BaseController, blobstore_handlers.BlobstoreUploadHandler):
+	"""Controller for file uploads.
+	
+	Files are sent straight to the blobstore, which streams them into
+	storage and then posts their BlobInfo to this controller, so they
+	never go through the instance. The index page gets the URL to
+	send the files to as upload_url (or as JSON, with .json).
+	
+	"""
+	
+	# Maximum size of each uploaded file, in bytes.
+	max_bytes = None
+	
+	def get(self, *a):
+		"""Handle GET requests."""
+		super(UploadController, self).get(*a)
+		
+		# Check for authorization:
+		self.check_authorized()
+		
+		upload_url = blobstore.create_upload_url(self.get_path(), max_bytes_per_blob=self.max_bytes)
+		self.send_data(upload_url = upload_url)
+		with stats.timed("index"): self.index()
+		
+		if self.request.get_extension() == "json":
+			self.render_json({"upload_url": upload_url})
+		
+		# Check if render flag is on:
+		if self.get_flag("render"):
+			self.response.render(self._template("index"), **self._params)
+	
+	def post(self, *a):
+		"""Handle the request the blobstore makes after an upload."""
+		super(UploadController, self).post(*a)
+		
+		# Check for authorization:
+		self.check_authorized()
+		
+		with stats.timed("upload"): self.upload(self.get_uploads())
+		
+		# The blobstore expects a redirect:
+		if self.response.status_int not in (301, 302, 303):
+			self.redirect(self.get_path())
+	
+	def get_path(self):
+		"""Get the current path, without its extension."""
+		path = self.request.path
+		extension = self.request.get_extension()
+		return path[:-len(extension) - 1] if extension else path
+	
+	### Methods child classes may override:
+	
+	def upload(self, blob_infos):
+		"""When files are uploaded. Gets a list of their BlobInfo.
+		The response is a redirect to the index page, unless this
+		method redirects somewhere else.
+		"""
+
+
+class DownloadController(BaseController, blobstore_handlers.BlobstoreDownloadHandler):
+	"""Controller for file downloads.
+	
+	Each file is served at the controller's path followed by its blob
+	key, and optionally a file name (e.g. /files/<key>/report.pdf).
+	
+	By default App Engine sends the file itself (X-AppEngine-BlobKey),
+	so it never goes through the instance. If serve_blobs is turned
+	off, the file is read from the blobstore in fixed-size chunks
+	instead, into the response: App Engine sends responses all at once,
+	so the whole file (or range) is held in memory, and files or ranges
+	over max_size are refused. Either way, Range and conditional
+	requests are supported.
+	
+	"""
+	_supports_download = True
+	allow_extensions = False
+	
+	# Let App Engine send the files (turn off to read them in chunks):
+	serve_blobs = True
+	
+	# Bytes read from the blobstore at a time when not serving blobs.
+	chunk_size = blobstore.MAX_BLOB_FETCH_SIZE
+	
+	# Largest response when not serving blobs (App Engine's limit is 32 MB).
+	max_size = 32 * 1024 * 1024
+	
+	# Send files as attachments, with their original file names.
+	save_as = False
+	
+	def get(self, *a):
+		"""Handle GET requests."""
+		super(DownloadController, self).get(*a)
+		
+		# Check for authorization:
+		self.check_authorized()
+		self.set_flag("render", False)
+		
+		blob_info = blobstore.BlobInfo.get(urllib.unquote(a[0])) if a and a[0] else None
+		if blob_info is None:
+			self.abort(404)
+		with stats.timed("download"): self.download(blob_info)
+		
+		# Conditional requests:
+		modified = calendar.timegm(blob_info.creation.utctimetuple())
+		self.response.headers["ETag"] = '"%s"' % blob_info.md5_hash
+		self.response.headers["Last-Modified"] = email.utils.formatdate(modified, usegmt=True)
+		if self.not_modified(blob_info.md5_hash, modified):
+			return self.response.set_status(304)
+		
+		if self.serve_blobs:
+			return self.send_blob(blob_info, save_as=self.save_as)
+		
+		self.response.headers["Accept-Ranges"] = "bytes"
+		self.response.headers["Content-Type"] = str(blob_info.content_type)
+		if self.save_as:
+			self.response.headers["Content-Disposition"] = str('attachment; filename="%s"' % blob_info.filename)
+		
+		size = blob_info.size
+		byte_range = _parse_range(self.request.headers.get("Range"), size)
+		if byte_range is False:
+			self.response.set_status(416)
+			self.response.headers["Content-Range"] = "bytes */%d" % size
+			return
+		if byte_range:
+			self.response.set_status(206)
+			self.response.headers["Content-Range"] = "bytes %d-%d/%d" % (byte_range + (size,))
+		start, end = byte_range or (0, size - 1)
+		if end - start + 1 > self.max_size:
+			if not byte_range:
+				logging.error("%s is too big to be read into a response" % blob_info.filename)
+				self.abort(500)
+			self.response.set_status(416)		# The client may ask for smaller ranges
+			self.response.headers["Content-Range"] = "bytes */%d" % size
+			return
+		
+		# Copy the file (or range) in chunks:
+		reader = blobstore.BlobReader(blob_info, buffer_size=self.chunk_size)
+		reader.seek(start)
+		remaining = end - start + 1
+		while remaining > 0:
+			chunk = reader.read(min(self.chunk_size, remaining))
+			if not chunk: break
+			self.response.out.write(chunk)
+			remaining -= len(chunk)
+	
+	def not_modified(self, etag, modified):
+		"""Determine whether the client's copy of the file is up to date."""
+		if_none_match = self.request.headers.get("If-None-Match")
+		if if_none_match:
+			tags = [t.strip().strip('"') for t in if_none_match.split(',')]
+			return '*' in tags or etag in tags
+		
+		if_modified_since = self.request.headers.get("If-Modified-Since")
+		if if_modified_since:
+			since = email.utils.parsedate_tz(if_modified_since)
+			return since is not None and modified <= email.utils.mktime_tz(since)
+		return False
+	
+	### Methods child classes may override:
+	
+	def download(self, blob_info):
+		"""Before sending a file. Call abort() or deny_access() to
+		stop it from being sent."""
+
+
+# These are used within the module.
+def _shareable(response):
+	"""Whether a response may be copied to other users' requests."""
+	if "Set-Cookie" in response.headers:
+		return False
+	cache_control = response.headers.get("Cache-Control", "").lower()
+	return "private" not in cache_control and "no-store" not in cache_control
+
+def _parse_range(header, size):
+	"""Get the (first, last) bytes of a single-range Range header.
+	
+	Returns None if there's no range to use (the whole file is
+	sent), or False if the range can't be satisfied.
+	
+	"""
+	match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+	if not match or not (match.group(1) or match.group(2)):
+		return None
+	if match.group(1):
+		start = int(match.group(1))
+		end = int(match.group(2)) if match.group(2) else size - 1
+	else:
+		start = max(size - int(match.group(2)), 0)		# Suffix range: the last bytes
+		end = size - 1
+	if start >= size or end < start:
+		return False
+	return start, min(end, size - 1)
+
+def _timed_matcher(router, request):
+	"""Match the request to a route, recording the time it takes."""
+	with stats.timed("route"):
+		match = webapp2.Router.default_matcher(router, request)
+	record = stats.current()
+	if record is not None:
+		record.route = match[0].template
+	return match
+
+# Paths of the named routes, as format strings (see url_for()).
+_reverse_routes = {}
+
+def _reverse_path(pattern):
+	"""Turn the path regexp of a controller into the path it matches,
+	or return None if it matches more than one."""
+	path = pattern.strip().lstrip('^').rstrip('$')
+	if re.search(r'[\[\](){}*+?|]|\\[^.\-/]', path):
+		return None
+	return re.sub(r'\\(.)', r'\1', path)
+
+# Makes concurrent warmup requests wait for the first one.
+_warmup_lock = threading.Lock()
+
+# Variables of the environ of a batch request that its requests share.
+_SHARED_ENVIRON = ("HTTP_", "USER_", "AUTH_DOMAIN", "SERVER_", "wsgi.url_scheme")
+
+def _class_name(cls):
+	"""Get the variable-like name of a controller class."""
+	try:
+		return _class_names[cls]
+	except KeyError:
+		return _class_names.setdefault(cls, _lowercase(cls.__name__))
+
+def _template_path(cls, page):
+	"""Get the path of a template of a controller class."""
+	try:
+		return _template_paths[cls, page]
+	except KeyError:
+		return _template_paths.setdefault((cls, page), _class_name(cls) + '/' + page + '.html')
 
+# Caches of the two functions above.
+_class_names = {}
+_template_paths = {}
 
-# This is used within the module.
 def _lowercase(s):
 	"""Convert class-like names to varliable-like names."""
 	s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', s)
@@ -0,0 +1,205 @@
+import json
+import math
+import time
+import logging
+import threading
+import contextlib
+import collections
+
+from google.appengine.api import apiproxy_stub_map
+
+
+# Number of requests kept per route for the percentiles.
+SAMPLE_SIZE = 1000
+
+# The request being measured in the current thread (threadsafe apps
+# handle several requests at once).
+_local = threading.local()
+
+
+class RequestStats(object):
+	"""Timings and datastore usage of a single request.
+	
+	Phases may be nested (the index() hook includes the datastore
+	calls it makes), so their durations don't add up to the total.
+	
+	"""
+	
+	def __init__(self, method, path):
+		self.method = method
+		self.path = path
+		self.route = None
+		self.start = time.time()
+		self.total = None
+		self.phases = collections.OrderedDict()
+		self.rpcs = 0
+		self.rpc_bytes = 0
+		self.rpc_time = 0.0
+		self.coalesced = False		# Whether the response was shared by another request
+		self._rpc_starts = {}
+	
+	def add(self, phase, seconds):
+		"""Add time to a phase."""
+		self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+	
+	def elapsed(self):
+		"""Seconds since the request started, or its total once finished."""
+		if self.total is not None:
+			return self.total
+		return time.time() - self.start
+	
+	def header(self):
+		"""Format the timings as a Server-Timing header value."""
+		parts = ['%s;dur=%.2f' % (p, s * 1000) for p, s in self.phases.items()]
+		if self.rpcs:
+			parts.append('datastore;dur=%.2f;desc="%d rpcs, %d bytes"'
+						 % (self.rpc_time * 1000, self.rpcs, self.rpc_bytes))
+		parts.append('total;dur=%.2f' % (self.elapsed() * 1000))
+		return ', '.join(parts)
+	
+	def as_dict(self):
+		"""Return the timings (in milliseconds) as a dictionary."""
+		return {
+			"method": self.method,
+			"path": self.path,
+			"route": self.route,
+			"total": round(self.elapsed() * 1000, 2),
+			"phases": dict((p, round(s * 1000, 2)) for p, s in self.phases.items()),
+			"rpcs": self.rpcs,
+			"rpc_bytes": self.rpc_bytes,
+			"rpc_time": round(self.rpc_time * 1000, 2),
+			"coalesced": self.coalesced,
+		}
+
+
+class Aggregate(object):
+	"""In-memory timings per route.
+	
+	Only the latest requests of every route are kept, so the
+	percentiles follow the current behaviour of the instance.
+	
+	"""
+	
+	def __init__(self, size=SAMPLE_SIZE):
+		self.size = size
+		self._lock = threading.Lock()
+		self._routes = {}
+		self._counts = collections.defaultdict(int)
+		self._coalesced = collections.defaultdict(int)
+	
+	def add(self, record):
+		"""Add a finished request."""
+		route = '%s %s' % (record.method, record.route)
+		with self._lock:
+			samples = self._routes.get(route)
+			if samples is None:
+				samples = self._routes[route] = collections.deque(maxlen=self.size)
+			samples.append((record.total, record.rpcs, record.rpc_bytes))
+			self._counts[route] += 1
+			if record.coalesced:
+				self._coalesced[route] += 1
+	
+	def summary(self):
+		"""Return the request count, p50/p95 latency (in milliseconds),
+		average datastore usage and number of coalesced requests of
+		every route."""
+		with self._lock:
+			routes = dict((r, list(s)) for r, s in self._routes.items())
+			counts = dict(self._counts)
+			coalesced = dict(self._coalesced)
+		
+		result = {}
+		for route, samples in routes.items():
+			totals = sorted(s[0] for s in samples)
+			result[route] = {
+				"count": counts[route],
+				"p50": round(percentile(totals, 50) * 1000, 2),
+				"p95": round(percentile(totals, 95) * 1000, 2),
+				"rpcs": round(sum(s[1] for s in samples) / float(len(samples)), 2),
+				"rpc_bytes": sum(s[2] for s in samples) // len(samples),
+				"coalesced": coalesced.get(route, 0),
+			}
+		return result
+	
+	def reset(self):
+		"""Forget every recorded request."""
+		with self._lock:
+			self._routes.clear()
+			self._counts.clear()
+			self._coalesced.clear()
+
+
+# Timings of every route in this instance.
+aggregate = Aggregate()
+
+
+def begin(method, path):
+	"""Start measuring a request in the current thread."""
+	record = _local.record = RequestStats(method, path)
+	return record
+
+def current():
+	"""Get the request being measured, or None."""
+	return getattr(_local, 'record', None)
+
+def finish():
+	"""Stop measuring the current request, log it and aggregate it."""
+	record = current()
+	if record is None:
+		return
+	_local.record = None
+	record.total = time.time() - record.start
+	aggregate.add(record)
+	logging.info("stats %s" % json.dumps(record.as_dict(), sort_keys=True))
+	return record
+
+@contextlib.contextmanager
+def timed(phase):
+	"""Add the time spent in the block to a phase of the current request.
+	Does nothing when no request is being measured."""
+	record = current()
+	if record is None:
+		yield
+		return
+	start = time.time()
+	try:
+		yield
+	finally:
+		record.add(phase, time.time() - start)
+
+def percentile(values, p):
+	"""Get the p-th percentile (nearest rank) of a sorted list."""
+	if not values:
+		return 0.0
+	rank = int(math.ceil(p / 100.0 * len(values))) - 1
+	return values[min(max(rank, 0), len(values) - 1)]
+
+
+### Datastore RPC hooks:
+
+def install_hooks():
+	"""Count the datastore RPCs made by measured requests.
+	The hooks are added to the current API proxy (testbeds replace it),
+	which ignores them if they're already there.
+	"""
+	apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+		'stats', _pre_call, 'datastore_v3')
+	apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+		'stats', _post_call, 'datastore_v3')
+
+def _pre_call(service, call, request, response, rpc):
+	record = current()
+	if record is not None:
+		record._rpc_starts[id(rpc)] = time.time()
+
+def _post_call(service, call, request, response, rpc):
+	record = current()
+	if record is None:
+		return
+	start = record._rpc_starts.pop(id(rpc), None)
+	if start is not None:
+		record.rpc_time += time.time() - start
+	record.rpcs += 1
+	try:
+		record.rpc_bytes += request.ByteSize() + response.ByteSize()
+	except AttributeError: pass
@@ -0,0 +1,151 @@
+import pickle
+import logging
+import functools
+import threading
+
+
+# Maximum number of tasks added to a queue in a single call.
+BATCH_SIZE = 100
+
+# Calls deferred by the request being handled in the current thread.
+_local = threading.local()
+
+
+class TaskQueueExecutor(object):
+	"""Run deferred calls on the App Engine task queue.
+	
+	Each call becomes a task of the deferred library (enable it with
+	the "deferred" builtin in app.yaml), so it's retried when it fails.
+	The tasks of a request are added in batches.
+	
+	"""
+	
+	def __init__(self, queue="default", retries=5):
+		self.queue = queue
+		self.retries = retries
+	
+	def submit(self, calls):
+		# Imported here, so that this module can be used without App Engine:
+		from google.appengine.api import taskqueue
+		from google.appengine.ext import deferred
+		
+		retry = taskqueue.TaskRetryOptions(task_retry_limit=self.retries)
+		tasks = [taskqueue.Task(payload=deferred.serialize(fn, *a, **kw),
+								url="/_ah/queue/deferred",
+								headers={"Content-Type": "application/octet-stream"},
+								retry_options=retry)
+				 for fn, a, kw in calls]
+		queue = taskqueue.Queue(self.queue)
+		for i in range(0, len(tasks), BATCH_SIZE):
+			queue.add(tasks[i:i + BATCH_SIZE])
+
+
+class LocalExecutor(object):
+	"""Run deferred calls in this process, once the request is done.
+	
+	This is a stand-in for the task queue in tests and local runs.
+	Calls go through pickle like real tasks, so arguments that can't
+	be sent to the queue fail here too. Calls that still fail after
+	the retries are kept in self.failed.
+	
+	"""
+	
+	def __init__(self, retries=2):
+		self.retries = retries
+		self.failed = []
+	
+	def submit(self, calls):
+		for call in calls:
+			fn, a, kw = pickle.loads(pickle.dumps(call))
+			for attempt in range(self.retries + 1):
+				try:
+					fn(*a, **kw)
+					break
+				except Exception:
+					logging.exception("Deferred call to %r failed (attempt %d)" % (fn, attempt + 1))
+			else:
+				self.failed.append(call)
+
+
+# Executor used for the deferred calls; see set_executor().
+executor = TaskQueueExecutor()
+
+def set_executor(e):
+	"""Change the executor of deferred calls (e.g. to a LocalExecutor)."""
+	global executor
+	executor = e
+
+
+def defer(fn, *a, **kw):
+	"""Call a function in the background.
+	
+	During a request, calls are sent to the executor when the request
+	is done; otherwise they are sent right away. The function and its
+	arguments must be picklable (module-level functions, entities...).
+	
+	"""
+	calls = getattr(_local, "calls", None)
+	if calls is None:
+		executor.submit([(fn, a, kw)])
+	else:
+		calls.append((fn, a, kw))
+
+
+def deferred(method):
+	"""Decorator that makes a controller hook run in the background.
+	
+	Use it on the hooks that shouldn't slow down the response, e.g.:
+	
+	    @tasks.deferred
+	    def create(self, resource):
+	        send_notifications(resource)
+	
+	The hook runs on a new instance of the controller, without a
+	request or response, so it may only use its arguments.
+	
+	"""
+	@functools.wraps(method)
+	def wrapper(self, *a, **kw):
+		defer(_call_hook, self.__class__, method.__name__, *a, **kw)
+	wrapper.deferred_method = method
+	return wrapper
+
+
+def begin(nested=False):
+	"""Start collecting the calls deferred by a request.
+	
+	Called when a controller starts dispatching a request. Requests
+	dispatched inside another one (e.g. in a batch) are nested, and
+	their calls are sent with the outer request's, unless they fail.
+	Other requests start afresh, whatever a previous request on the
+	thread left behind.
+	
+	"""
+	if not nested or not getattr(_local, "depth", 0):
+		_local.depth = 0
+		_local.calls = []
+		_local.starts = []
+	_local.starts.append(len(_local.calls))		# Where this request's calls start
+	_local.depth += 1
+
+def flush(discard=False):
+	"""Send the collected calls to the executor (or drop them).
+	Called when a controller is done with a request.
+	"""
+	_local.depth -= 1
+	start = _local.starts.pop()
+	if _local.depth:
+		if discard:
+			del _local.calls[start:]
+		return		# Still inside another request (e.g. a batch)
+	calls, _local.calls = _local.calls, None
+	if calls and discard:
+		logging.warning("Dropped %d deferred calls of a failed request" % len(calls))
+	elif calls:
+		executor.submit(calls)
+
+
+# This is used within the module.
+def _call_hook(cls, name, *a, **kw):
+	"""Run a deferred hook of a controller class."""
+	getattr(cls, name).deferred_method(cls(), *a, **kw)
@@ -0,0 +1,73 @@
+import SocketServer
+from wsgiref import simple_server
+
+import webapp2
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+
+def setup_testbed(datastore_file=None):
+	"""Activate the App Engine service stubs in this process.
+	
+	This makes it possible to run the app outside of the development
+	server, e.g. in tests and benchmarks. The datastore is kept in
+	memory unless a file is given (in the SQLite format that the
+	development server uses).
+	
+	"""
+	tb = testbed.Testbed()
+	tb.activate()
+	tb.setup_env(overwrite=True)
+	policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+	tb.init_datastore_v3_stub(consistency_policy=policy,
+							  datastore_file=datastore_file,
+							  use_sqlite=datastore_file is not None,
+							  save_changes=datastore_file is not None)
+	tb.init_memcache_stub()
+	tb.init_taskqueue_stub()
+	tb.init_user_stub()
+	tb.init_blobstore_stub()
+	tb.init_app_identity_stub()
+	tb.init_urlfetch_stub()
+	return tb
+
+
+def request(app, path, method="GET", form=None, headers=None):
+	"""Send a request to the app in-process and return the response.
+	
+	Like on App Engine, every request starts with an empty ndb
+	context cache.
+	
+	"""
+	ndb.get_context().clear_cache()
+	req = webapp2.Request.blank(path, headers=headers, POST=form)
+	req.method = method
+	return req.get_response(app)
+
+
+def serve(app, port=8080, host="localhost"):
+	"""Serve the app with a threaded WSGI server until interrupted."""
+	server = simple_server.make_server(host, port, app,
+									   server_class=_ThreadedServer,
+									   handler_class=_QuietHandler)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt: pass
+
+
+def serve_main(port=8080):
+	"""Serve the project's app (main.app) on the testbed stubs.
+	Used by `we --bench`; must be run from the project's folder.
+	"""
+	setup_testbed()
+	import main
+	serve(main.app, port)
+
+
+# These are used within the module.
+class _ThreadedServer(SocketServer.ThreadingMixIn, simple_server.WSGIServer):
+	daemon_threads = True
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+	def log_message(self, *a): pass
@@ -0,0 +1,86 @@
+"""Shared setup for the tests.
+
+Puts the project template (src/static) on sys.path, and the App Engine
+SDK if the APPENGINE_SDK environment variable gives its path. Tests of
+the modules that need the SDK are skipped without it:
+
+	APPENGINE_SDK=~/google_appengine python -m unittest discover -s tests
+
+"""
+
+import os
+import shutil
+import tempfile
+import sys
+import time
+import unittest
+
+
+# The project template that `we -n` copies.
+STATIC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'static'))
+
+sys.path.insert(0, STATIC_DIR)
+
+if os.environ.get('APPENGINE_SDK'):
+	sys.path.insert(0, os.path.expanduser(os.environ['APPENGINE_SDK']))
+	import dev_appserver
+	dev_appserver.fix_sys_path()
+
+try:
+	from google.appengine.api import memcache
+	HAS_SDK = True
+except ImportError:
+	HAS_SDK = False
+
+# Decorator for the tests that need the SDK.
+needs_sdk = unittest.skipUnless(HAS_SDK, "needs the App Engine SDK (set APPENGINE_SDK)")
+
+
+def wait_until(condition, timeout=5):
+	"""Wait for another thread to make condition() true."""
+	deadline = time.time() + timeout
+	while not condition():
+		if time.time() > deadline:
+			raise AssertionError("timed out waiting for %s" % condition.__name__)
+		time.sleep(0.001)
+
+
+class AppTestCase(unittest.TestCase):
+	"""Base of the tests that send requests to an app in-process.
+	
+	Each test gets fresh service stubs and an app with the controllers
+	of the class routed. Templates are written to a temporary views
+	folder from the views dict, which maps their paths to their source.
+	
+	"""
+	
+	controllers = ()
+	views = {}
+	
+	def setUp(self):
+		from lib import server, testing
+		self.testbed = testing.setup_testbed()
+		self.views_dir = tempfile.mkdtemp(prefix='we-test-')
+		for path, source in self.views.items():
+			path = os.path.join(self.views_dir, path)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(path, 'w') as f:
+				f.write(source)
+		
+		self.app = server.webapp_enhanced()
+		self.app.set_views_folder(self.views_dir)
+		self.configure(self.app)
+		self.app.route(self.controllers)
+		self.app.start()
+	
+	def tearDown(self):
+		self.testbed.deactivate()
+		shutil.rmtree(self.views_dir, True)
+	
+	def configure(self, app):
+		"""Change the app before it's started, e.g. to enable stats."""
+	
+	def request(self, path, method="GET", form=None, headers=None):
+		from lib import testing
+		return testing.request(self.app, path, method, form, headers)
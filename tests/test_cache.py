@@ -0,0 +1,131 @@
+import time
+import threading
+import unittest
+
+import support
+
+
+@support.needs_sdk
+class SingleFlightTest(unittest.TestCase):
+	
+	def setUp(self):
+		from lib import cache
+		self.flight = cache.SingleFlight()
+	
+	def run_together(self, n, fn, key="key"):
+		"""Call do() from n threads while the first call is running.
+		Returns what each thread got, or the exception it raised."""
+		started = threading.Event()
+		release = threading.Event()
+		def leader_fn():
+			started.set()
+			release.wait(5)
+			return fn()
+		
+		results = []
+		def call(f):
+			try:
+				results.append(self.flight.do(key, f))
+			except Exception as e:
+				results.append(e)
+		
+		leader = threading.Thread(target=call, args=(leader_fn,))
+		leader.start()
+		started.wait(5)
+		followers = [threading.Thread(target=call, args=(fn,)) for _ in range(n - 1)]
+		for t in followers:
+			t.start()
+		while self.flight.coalesced < n - 1:
+			time.sleep(0.001)		# Until they all wait for the leader
+		release.set()
+		for t in [leader] + followers:
+			t.join(5)
+		return results
+	
+	def test_concurrent_calls_share_the_result(self):
+		calls = []
+		def fn():
+			calls.append(1)
+			return "page"
+		results = self.run_together(5, fn)
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(sorted(results), [("page", False)] + [("page", True)] * 4)
+		self.assertEqual((self.flight.calls, self.flight.coalesced), (1, 4))
+	
+	def test_concurrent_calls_share_the_exception(self):
+		def fn():
+			raise ValueError("failed")
+		results = self.run_together(3, fn)
+		self.assertEqual(len(results), 3)
+		for e in results:
+			self.assertIsInstance(e, ValueError)
+	
+	def test_sequential_calls_run_again(self):
+		self.assertEqual(self.flight.do("key", lambda: 1), (1, False))
+		self.assertEqual(self.flight.do("key", lambda: 2), (2, False))
+		self.assertEqual((self.flight.calls, self.flight.coalesced), (2, 0))
+	
+	def test_the_key_is_released_after_an_exception(self):
+		def fn():
+			raise ValueError()
+		self.assertRaises(ValueError, self.flight.do, "key", fn)
+		self.assertEqual(self.flight.do("key", lambda: 1), (1, False))
+	
+	def test_different_keys_dont_wait(self):
+		inner = []
+		def fn():
+			inner.append(self.flight.do("other", lambda: "inner"))
+			return "outer"
+		self.assertEqual(self.flight.do("key", fn), ("outer", False))
+		self.assertEqual(inner, [("inner", False)])
+	
+	def test_followers_run_the_function_after_the_timeout(self):
+		self.flight.timeout = 0.01
+		results = []
+		release = threading.Event()
+		def slow():
+			release.wait(5)
+			return "slow"
+		leader = threading.Thread(target=lambda: results.append(self.flight.do("key", slow)))
+		leader.start()
+		while not self.flight.calls:
+			time.sleep(0.001)
+		self.assertEqual(self.flight.do("key", lambda: "own"), ("own", False))
+		release.set()
+		leader.join(5)
+		self.assertEqual(results, [("slow", False)])
+
+
+@support.needs_sdk
+class LRUCacheTest(unittest.TestCase):
+	
+	def test_least_recently_used_values_are_dropped(self):
+		from lib import cache
+		lru = cache.LRUCache(size=2)
+		lru.set("a", 1)
+		lru.set("b", 2)
+		lru.get("a")
+		lru.set("c", 3)
+		self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+	
+	def test_expired_values_are_missing(self):
+		from lib import cache
+		lru = cache.LRUCache()
+		lru.set("a", 1, ttl=-1)
+		self.assertEqual(lru.get("a", "missing"), "missing")
+
+	
+	def test_weighed_values_are_dropped_by_total_weight(self):
+		from lib import cache
+		lru = cache.LRUCache(size=10, weigh=len)
+		lru.set("a", "x" * 4)
+		lru.set("b", "x" * 4)
+		lru.set("c", "x" * 4)
+		self.assertEqual((lru.get("a"), len(lru), lru.weight), (None, 2, 8))
+		lru.set("d", "x" * 11)		# Heavier than the whole cache
+		self.assertEqual((lru.get("d"), lru.weight), (None, 8))
+		lru.delete("b")
+		self.assertEqual(lru.weight, 4)
+
+if __name__ == '__main__':
+	unittest.main()
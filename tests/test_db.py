@@ -0,0 +1,111 @@
+import unittest
+
+import support
+
+if support.HAS_SDK:
+	from google.appengine.ext import ndb
+	from lib import db, testing
+	
+	class CachedItem(db.Model):
+		name = db.string()
+		cache_queries = True
+	
+	class CountedItem(db.Model):
+		name = db.string()
+		counted = True
+
+
+@support.needs_sdk
+class QueryCacheTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.testbed = testing.setup_testbed()
+		db._query_cache.clear()
+		self.delay = db.QUERY_CACHE_DELAY
+	
+	def tearDown(self):
+		db.QUERY_CACHE_DELAY = self.delay
+		self.testbed.deactivate()
+	
+	def names(self):
+		return sorted(e.name for e in CachedItem.all())
+	
+	def test_results_are_cached_until_the_next_save(self):
+		db.QUERY_CACHE_DELAY = 0
+		CachedItem.create(name="a")
+		self.assertEqual(self.names(), ["a"])
+		CachedItem(name="b").put()		# Doesn't change the generation
+		self.assertEqual(self.names(), ["a"])
+		CachedItem.create(name="c")
+		self.assertEqual(self.names(), ["a", "b", "c"])
+	
+	def test_results_arent_cached_right_after_a_write(self):
+		CachedItem.create(name="a")
+		self.assertEqual(self.names(), ["a"])
+		CachedItem(name="b").put()
+		self.assertEqual(self.names(), ["a", "b"])
+		self.assertEqual(len(db._query_cache), 0)
+	
+	def test_the_instance_cache_is_bounded_by_bytes(self):
+		db.QUERY_CACHE_DELAY = 0
+		CachedItem.create(name="x" * 1000)
+		CachedItem.all()
+		self.assertGreater(db._query_cache.weight, 1000)
+		self.assertLessEqual(db._query_cache.weight, db.QUERY_CACHE_SIZE)
+
+
+
+@support.needs_sdk
+class CountTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.testbed = testing.setup_testbed()
+	
+	def tearDown(self):
+		self.testbed.deactivate()
+	
+	def test_new_entities_are_counted(self):
+		CountedItem.create(name="a")
+		CountedItem(id=42, name="b").save()
+		self.assertEqual(CountedItem.count(), 2)
+	
+	def test_updates_arent_counted(self):
+		item = CountedItem.create(name="a")
+		item.name = "b"
+		item.save()
+		CountedItem(id=item.key.id(), name="c").save()
+		self.assertEqual(CountedItem.count(), 1)
+	
+	def test_destroying_twice_counts_once(self):
+		item = CountedItem.create(name="a")
+		CountedItem.create(name="b")
+		item.destroy()
+		item.destroy()
+		self.assertEqual(CountedItem.count(), 1)
+	
+	def test_writes_join_the_current_transaction(self):
+		CountedItem.count()		# Cache the count
+		def txn():
+			CountedItem.create(name="a")
+			CountedItem.create(name="b").destroy()
+		ndb.transaction(txn, xg=True)
+		self.assertEqual(CountedItem.count(), 1)
+		self.assertEqual(CountedItem.query().count(), 1)
+	
+	def test_nothing_is_counted_when_the_transaction_fails(self):
+		CountedItem.count()
+		def txn():
+			CountedItem.create(name="a")
+			raise ValueError()
+		self.assertRaises(ValueError, ndb.transaction, txn, xg=True)
+		self.assertEqual(CountedItem.count(), 0)
+		self.assertEqual(CountedItem.query().count(), 0)
+	
+	def test_recount(self):
+		CountedItem(name="a").put()		# Not counted
+		self.assertEqual(CountedItem.count(), 0)
+		CountedItem.recount()
+		self.assertEqual(CountedItem.count(), 1)
+
+if __name__ == '__main__':
+	unittest.main()
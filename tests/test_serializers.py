@@ -0,0 +1,119 @@
+import unittest
+
+import support
+from lib import serializers
+
+
+def pack(obj):
+	"""Encode with the pure-Python encoder."""
+	chunks = []
+	serializers._pack(obj, chunks.append)
+	return "".join(chunks)
+
+
+class PackTest(unittest.TestCase):
+	"""The pure-Python encoder, against the MessagePack spec."""
+	
+	def test_nil_and_booleans(self):
+		self.assertEqual(pack(None), "\xc0")
+		self.assertEqual(pack(False), "\xc2")
+		self.assertEqual(pack(True), "\xc3")
+	
+	def test_positive_integers(self):
+		self.assertEqual(pack(0), "\x00")
+		self.assertEqual(pack(0x7f), "\x7f")		# positive fixint
+		self.assertEqual(pack(0x80), "\xcc\x80")		# uint 8
+		self.assertEqual(pack(0xff), "\xcc\xff")
+		self.assertEqual(pack(0x100), "\xcd\x01\x00")		# uint 16
+		self.assertEqual(pack(0xffff), "\xcd\xff\xff")
+		self.assertEqual(pack(0x10000), "\xce\x00\x01\x00\x00")		# uint 32
+		self.assertEqual(pack(0xffffffff), "\xce\xff\xff\xff\xff")
+		self.assertEqual(pack(0x100000000), "\xcf\x00\x00\x00\x01\x00\x00\x00\x00")		# uint 64
+		self.assertEqual(pack(5629499534213120L), "\xcf\x00\x14\x00\x00\x00\x00\x00\x00")
+	
+	def test_negative_integers(self):
+		self.assertEqual(pack(-1), "\xff")		# negative fixint
+		self.assertEqual(pack(-32), "\xe0")
+		self.assertEqual(pack(-33), "\xd0\xdf")		# int 8
+		self.assertEqual(pack(-0x80), "\xd0\x80")
+		self.assertEqual(pack(-0x81), "\xd1\xff\x7f")		# int 16
+		self.assertEqual(pack(-0x8000), "\xd1\x80\x00")
+		self.assertEqual(pack(-0x8001), "\xd2\xff\xff\x7f\xff")		# int 32
+		self.assertEqual(pack(-0x80000000), "\xd2\x80\x00\x00\x00")
+		self.assertEqual(pack(-0x80000001), "\xd3\xff\xff\xff\xff\x7f\xff\xff\xff")		# int 64
+	
+	def test_integers_out_of_range(self):
+		self.assertRaises(ValueError, pack, 2 ** 64)
+		self.assertRaises(ValueError, pack, -2 ** 63 - 1)
+	
+	def test_floats_are_float_64(self):
+		self.assertEqual(pack(1.5), "\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00")
+		self.assertEqual(pack(-0.0), "\xcb\x80\x00\x00\x00\x00\x00\x00\x00")
+	
+	def test_strings(self):
+		self.assertEqual(pack(""), "\xa0")		# fixstr
+		self.assertEqual(pack("abc"), "\xa3abc")
+		self.assertEqual(pack("a" * 31), "\xbf" + "a" * 31)
+		self.assertEqual(pack("a" * 32), "\xda\x00\x20" + "a" * 32)		# raw 16, not str 8
+		self.assertEqual(pack("a" * 0x100), "\xda\x01\x00" + "a" * 0x100)		# raw 16
+		self.assertEqual(pack("a" * 0x10000), "\xdb\x00\x01\x00\x00" + "a" * 0x10000)		# raw 32
+	
+	def test_unicode_is_encoded_as_utf8(self):
+		self.assertEqual(pack(u"\xe9t\xe9"), "\xa5\xc3\xa9t\xc3\xa9")
+	
+	def test_arrays(self):
+		self.assertEqual(pack([]), "\x90")		# fixarray
+		self.assertEqual(pack([1, "a", None]), "\x93\x01\xa1a\xc0")
+		self.assertEqual(pack((1, 2)), "\x92\x01\x02")
+		self.assertEqual(pack([0] * 15), "\x9f" + "\x00" * 15)
+		self.assertEqual(pack([0] * 16), "\xdc\x00\x10" + "\x00" * 16)		# array 16
+		self.assertEqual(pack([0] * 0x10000), "\xdd\x00\x01\x00\x00" + "\x00" * 0x10000)		# array 32
+	
+	def test_maps(self):
+		self.assertEqual(pack({}), "\x80")		# fixmap
+		self.assertEqual(pack({"a": 1}), "\x81\xa1a\x01")
+		self.assertEqual(pack({"a": [True]}), "\x81\xa1a\x91\xc3")
+		big = dict((i, 0) for i in range(16))
+		self.assertEqual(pack(big)[:3], "\xde\x00\x10")		# map 16
+		self.assertEqual(len(pack(big)), 3 + 16 * 2)
+	
+	def test_other_types_are_refused(self):
+		self.assertRaises(TypeError, pack, object())
+		self.assertRaises(TypeError, pack, set([1]))
+	
+	def test_same_bytes_as_the_msgpack_package(self):
+		if serializers.msgpack is None:
+			self.skipTest("msgpack isn't installed")
+		data = [None, True, -1, -200, 300, 2 ** 40, 0.25, "abc", "a" * 40, u"\xe9", ["x"] * 20, {"k": {"v": 1}}]
+		self.assertEqual(pack(data), serializers.msgpack.packb(data, use_bin_type=False))
+
+
+class FindTest(unittest.TestCase):
+	
+	def test_by_extension(self):
+		self.assertEqual(serializers.find("msgpack").content_type, "application/x-msgpack")
+		self.assertIsNone(serializers.find("yaml"))
+	
+	def test_the_extension_wins_over_accept(self):
+		self.assertEqual(serializers.find("xml", "application/json").extension, "xml")
+	
+	def test_by_accept_in_order_of_quality(self):
+		accept = "text/html, application/json;q=0.5, application/x-msgpack;q=0.9"
+		self.assertEqual(serializers.find(accept=accept).extension, "msgpack")
+		self.assertEqual(serializers.find(accept="Application/XML").extension, "xml")
+	
+	def test_nothing_registered_is_accepted(self):
+		self.assertIsNone(serializers.find(accept="text/html, */*;q=0.1"))
+		self.assertIsNone(serializers.find())
+	
+	def test_register(self):
+		s = serializers.register("txt", "text/plain", str)
+		try:
+			self.assertIs(serializers.find(accept="text/plain"), s)
+			self.assertEqual(s.dumps(1), "1")
+		finally:
+			del serializers._by_extension["txt"], serializers._by_content_type["text/plain"]
+
+
+if __name__ == '__main__':
+	unittest.main()
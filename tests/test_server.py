@@ -0,0 +1,528 @@
+import datetime
+import logging
+import threading
+import unittest
+
+import support
+
+if support.HAS_SDK:
+	from lib import db, server, stats
+	
+	class BatchItemModel(db.Model):
+		name = db.string()
+	
+	class StatsItemModel(db.Model):
+		name = db.string()
+	
+	class SearchItemModel(db.Model):
+		name = db.string()
+		description = db.text()
+		searchable = {"name": 2, "description": 1}
+	
+	class FeedItemModel(db.Model):
+		name = db.string()
+		feed = True
+
+
+@support.needs_sdk
+class ParseRangeTest(unittest.TestCase):
+	
+	def parse(self, header, size=100):
+		from lib import server
+		return server._parse_range(header, size)
+	
+	def test_no_range(self):
+		self.assertIsNone(self.parse(None))
+		self.assertIsNone(self.parse(""))
+		self.assertIsNone(self.parse("bytes=-"))
+	
+	def test_ranges(self):
+		self.assertEqual(self.parse("bytes=0-9"), (0, 9))
+		self.assertEqual(self.parse(" bytes=10-19 "), (10, 19))
+		self.assertEqual(self.parse("bytes=0-0"), (0, 0))
+	
+	def test_open_range_goes_to_the_end(self):
+		self.assertEqual(self.parse("bytes=90-"), (90, 99))
+	
+	def test_suffix_range_is_the_last_bytes(self):
+		self.assertEqual(self.parse("bytes=-10"), (90, 99))
+		self.assertEqual(self.parse("bytes=-500"), (0, 99))
+	
+	def test_end_is_capped_to_the_size(self):
+		self.assertEqual(self.parse("bytes=50-500"), (50, 99))
+	
+	def test_unsatisfiable(self):
+		self.assertIs(self.parse("bytes=100-"), False)
+		self.assertIs(self.parse("bytes=20-10"), False)
+		self.assertIs(self.parse("bytes=-10", size=0), False)
+	
+	def test_unsupported_ranges_send_the_whole_file(self):
+		self.assertIsNone(self.parse("bytes=0-9,20-29"))
+		self.assertIsNone(self.parse("items=0-9"))
+		self.assertIsNone(self.parse("bytes=a-b"))
+
+
+@support.needs_sdk
+class ReversePathTest(unittest.TestCase):
+	
+	def reverse(self, pattern):
+		from lib import server
+		return server._reverse_path(pattern)
+	
+	def test_plain_paths(self):
+		self.assertEqual(self.reverse("/items"), "/items")
+		self.assertEqual(self.reverse("^/items$"), "/items")
+		self.assertEqual(self.reverse(" /my-items "), "/my-items")
+	
+	def test_escaped_characters(self):
+		self.assertEqual(self.reverse(r"/items\.old"), "/items.old")
+		self.assertEqual(self.reverse(r"/a\-b\/c"), "/a-b/c")
+	
+	def test_patterns_that_match_several_paths(self):
+		for pattern in ["/items/(\d+)", "/items?", "/item.*", "/[a-z]+", "/a|/b", r"/items\d", "/x{2}"]:
+			self.assertIsNone(self.reverse(pattern), pattern)
+
+
+@support.needs_sdk
+class ShareableTest(unittest.TestCase):
+	
+	def shareable(self, **headers):
+		import webapp2
+		from lib import server
+		response = webapp2.Response()
+		for name, value in headers.items():
+			response.headers[name.replace("_", "-")] = value
+		return server._shareable(response)
+	
+	def test_public_responses_are_shared(self):
+		self.assertTrue(self.shareable())
+		self.assertTrue(self.shareable(Cache_Control="public, max-age=60"))
+	
+	def test_private_responses_arent_shared(self):
+		self.assertFalse(self.shareable(Set_Cookie="session=1"))
+		self.assertFalse(self.shareable(Cache_Control="private"))
+		self.assertFalse(self.shareable(Cache_Control="No-Store"))
+
+
+def coalesced_controllers():
+	"""Make the controllers of CoalescedDispatchTest."""
+	from lib import server
+	
+	class Secret(server.AJAXController):
+		coalesce = True
+		calls = []
+		release = threading.Event()
+		
+		def authorized(self):
+			return self.request.headers.get("X-Token") == "admin"
+		
+		def GET(self):
+			self.calls.append(self.request.headers.get("Cookie"))
+			self.release.wait(5)
+			self.response.out.write("top secret")
+	
+	return [Secret]
+
+
+@support.needs_sdk
+class CoalescedDispatchTest(support.AppTestCase):
+	
+	def setUp(self):
+		self.controllers = coalesced_controllers()
+		self.secret = self.controllers[0]
+		super(CoalescedDispatchTest, self).setUp()
+	
+	def tearDown(self):
+		self.secret.release.set()
+		super(CoalescedDispatchTest, self).tearDown()
+	
+	def start_leader(self):
+		"""Send an authorized request that waits until released."""
+		responses = []
+		thread = threading.Thread(target=lambda: responses.append(
+			self.request("/secret", headers={"X-Token": "admin"})))
+		thread.start()
+		support.wait_until(lambda: self.secret.calls)
+		return thread, responses
+	
+	def test_identical_requests_share_the_response(self):
+		leader, responses = self.start_leader()
+		follower = threading.Thread(target=lambda: responses.append(
+			self.request("/secret", headers={"X-Token": "admin"})))
+		follower.start()
+		support.wait_until(lambda: self.app.single_flight.coalesced)
+		self.secret.release.set()
+		leader.join(5)
+		follower.join(5)
+		self.assertEqual([(r.status_int, r.body) for r in responses], [(200, "top secret")] * 2)
+		self.assertEqual(len(self.secret.calls), 1)
+	
+	def test_unauthorized_requests_dont_get_the_response(self):
+		leader, responses = self.start_leader()
+		response = self.request("/secret")		# Without the token
+		self.secret.release.set()
+		leader.join(5)
+		self.assertEqual(response.status_int, 401)
+		self.assertNotIn("top secret", response.body)
+		self.assertEqual(responses[0].body, "top secret")
+		self.assertEqual(self.app.single_flight.coalesced, 0)
+	
+	def test_requests_with_cookies_arent_coalesced(self):
+		leader, responses = self.start_leader()
+		follower = threading.Thread(target=lambda: responses.append(
+			self.request("/secret", headers={"X-Token": "admin", "Cookie": "session=2"})))
+		follower.start()
+		support.wait_until(lambda: len(self.secret.calls) == 2)
+		self.secret.release.set()
+		leader.join(5)
+		follower.join(5)
+		self.assertEqual(sorted(self.secret.calls), [None, "session=2"])
+		self.assertEqual(self.app.single_flight.coalesced, 0)
+
+
+def batch_controllers():
+	"""Make the controllers of BatchTest."""
+	class BatchItem(server.ModelController):
+		model = BatchItemModel
+		
+		def index(self):
+			if self.request.get_extension() == "json":
+				self.render_json([r.name for r in self.resources])
+		
+		def show(self):
+			if self.request.get_extension() == "json":
+				self.render_json(self.resource.name)
+	
+	class FilteredItem(BatchItem):
+		def get_resources(self):
+			return [r for r in self.model.all() if r.name.startswith("b")]
+	
+	class Page(server.AJAXController):
+		def GET(self):
+			self.response.out.write("page")
+	
+	return [BatchItem, FilteredItem, Page]
+
+
+@support.needs_sdk
+class BatchTest(support.AppTestCase):
+	
+	def setUp(self):
+		self.controllers = batch_controllers()
+		super(BatchTest, self).setUp()
+		self.first = BatchItemModel(name="a").put().id()
+		BatchItemModel(name="b").put()
+		stats.aggregate.reset()
+	
+	def configure(self, app):
+		app.enable_stats()
+		app.enable_batch()
+	
+	def batch(self, *paths):
+		response = self.request("/_batch?" + "&".join("path=" + p for p in paths))
+		self.assertEqual(response.status_int, 200)
+		return response.json
+	
+	def test_responses_in_order(self):
+		self.assertEqual(self.batch("/batch_items/%d.json" % self.first, "/batch_items.json",
+									"/page", "/missing", "/batch_items/999.json"), [
+			{"path": "/batch_items/%d.json" % self.first, "status": 200, "body": "a"},
+			{"path": "/batch_items.json", "status": 200, "body": ["a", "b"]},
+			{"path": "/page", "status": 200, "body": "page"},
+			{"path": "/missing", "status": 404, "body": ""},
+			{"path": "/batch_items/999.json", "status": 404, "body": ""},
+		])
+	
+	def test_overridden_listings_are_used(self):
+		self.assertEqual(self.batch("/filtered_items.json", "/batch_items.json"), [
+			{"path": "/filtered_items.json", "status": 200, "body": ["b"]},
+			{"path": "/batch_items.json", "status": 200, "body": ["a", "b"]},
+		])
+	
+	def test_the_batch_is_recorded_under_its_own_route(self):
+		self.batch("/batch_items.json", "/page")
+		self.assertEqual(stats.aggregate.summary().keys(), ["GET ^/_batch$"])
+	
+	def test_limits(self):
+		self.assertEqual(self.request("/_batch").status_int, 400)
+		self.assertEqual(self.request("/_batch?" + "&".join(["path=/page"] * 21)).status_int, 400)
+		self.assertEqual(self.request("/_batch?path=/_batch").status_int, 400)
+
+
+def stats_controllers():
+	"""Make the controllers of StatsTest."""
+	class Listing(server.AJAXController):
+		def GET(self):
+			self.response.out.write(len(StatsItemModel.query().fetch()))
+	
+	return [Listing]
+
+
+@support.needs_sdk
+class StatsTest(support.AppTestCase):
+	
+	def setUp(self):
+		self.controllers = stats_controllers()
+		super(StatsTest, self).setUp()
+		StatsItemModel(name="a").put()
+		stats.aggregate.reset()
+	
+	def configure(self, app):
+		app.enable_stats("/_stats")
+	
+	def test_responses_have_the_timings(self):
+		timing = self.request("/listing").headers["Server-Timing"]
+		self.assertIn("get;dur=", timing)
+		self.assertIn('desc="1 rpcs, ', timing)
+		self.assertIn("total;dur=", timing)
+	
+	def test_timings_are_kept_per_route(self):
+		self.request("/listing")
+		self.request("/listing.json")
+		self.request("/missing")
+		summary = stats.aggregate.summary()
+		self.assertEqual(sorted(summary), ["GET None", "GET ^/listing(?:\\.(.+))?$"])
+		self.assertEqual(summary["GET ^/listing(?:\\.(.+))?$"]["count"], 2)
+		self.assertEqual(summary["GET ^/listing(?:\\.(.+))?$"]["rpcs"], 1)
+	
+	def test_only_admins_see_the_timings(self):
+		self.request("/listing")
+		self.assertEqual(self.request("/_stats").status_int, 401)
+		self.testbed.setup_env(user_email="admin@example.com", user_id="1",
+							   user_is_admin="1", overwrite=True)
+		self.assertIn("GET ^/listing(?:\\.(.+))?$", self.request("/_stats").json)
+		self.request("/_stats?reset=1")
+		self.assertEqual(self.request("/_stats").json.keys(), ["GET ^/_stats$"])
+
+
+def search_controllers():
+	"""Make the controllers of SearchTest."""
+	class SearchItem(server.ModelController):
+		model = SearchItemModel
+		per_page = 2
+		
+		def index(self):
+			self.render_json({"names": [r.name for r in self.resources],
+							  "total": self._params.get("total"),
+							  "pages": self._params.get("pages")})
+	
+	return [SearchItem]
+
+
+@support.needs_sdk
+class SearchTest(support.AppTestCase):
+	
+	def setUp(self):
+		self.controllers = search_controllers()
+		super(SearchTest, self).setUp()
+		self.apple = SearchItemModel.create(name="Red apple", description="A fruit")
+		SearchItemModel.create(name="Red car", description="A fast red car")
+		SearchItemModel.create(name="Blue car", description="")
+	
+	def search(self, query):
+		response = self.request("/search_items.json?q=" + query)
+		self.assertEqual(response.status_int, 200)
+		return response.json
+	
+	def test_best_matches_first(self):
+		self.assertEqual(self.search("red"), {"names": ["Red car", "Red apple"], "total": 2, "pages": 1})
+	
+	def test_every_word_must_match(self):
+		self.assertEqual(self.search("CAR+red")["names"], ["Red car"])
+		self.assertEqual(self.search("green")["names"], [])
+		self.assertEqual(sorted(self.search("car")["names"]), ["Blue car", "Red car"])
+	
+	def test_pages(self):
+		self.assertEqual(self.search("a")["names"], [])		# Words of one letter aren't indexed
+		SearchItemModel.create(name="Red bike", description="")
+		self.assertEqual(self.search("red")["pages"], 2)
+		self.assertEqual(self.search("red&page=2")["names"], ["Red apple"])
+		self.assertEqual(self.search("red&page=x")["names"], ["Red bike", "Red car"])		# Shorter ranks higher
+	
+	def test_the_index_follows_writes(self):
+		self.apple.name = "Green apple"
+		self.apple.save()
+		self.assertEqual(self.search("red")["names"], ["Red car"])
+		self.assertEqual(self.search("green")["names"], ["Green apple"])
+		self.apple.destroy()
+		self.assertEqual(self.search("apple")["names"], [])
+	
+	def test_without_a_query_everything_is_listed(self):
+		self.assertEqual(len(self.request("/search_items.json").json["names"]), 3)
+
+
+def feed_controllers():
+	"""Make the controllers of FeedTest."""
+	class ItemFeed(server.FeedController):
+		model = FeedItemModel
+		timeout = 5
+		poll_interval = 0.01
+	
+	return [ItemFeed]
+
+
+@support.needs_sdk
+class FeedTest(support.AppTestCase):
+	
+	def setUp(self):
+		self.controllers = feed_controllers()
+		self.feed = self.controllers[0]
+		super(FeedTest, self).setUp()
+		self.a = FeedItemModel.create(name="a")
+		b = FeedItemModel.create(name="b")
+		self.a.name = "A"
+		self.a.save()
+		b.destroy()
+	
+	def changes(self, query=""):
+		response = self.request("/item_feed" + query)
+		self.assertEqual(response.status_int, 200)
+		return response.json
+	
+	def test_every_change_in_order(self):
+		feed = self.changes()
+		self.assertEqual([(c["seq"], c["action"]) for c in feed["changes"]],
+						 [(1, "create"), (2, "create"), (3, "update"), (4, "destroy")])
+		self.assertEqual(feed["changes"][2]["data"]["name"], "A")
+		self.assertEqual(feed["changes"][2]["id"], self.a.key.id())
+		self.assertIsNone(feed["changes"][3]["data"])
+		self.assertEqual(feed["since"], 4)
+	
+	def test_changes_since_a_sequence_number(self):
+		self.assertEqual([c["seq"] for c in self.changes("?since=2")["changes"]], [3, 4])
+		self.assertEqual(self.changes("?since=4"), {"changes": [], "since": 4})
+		self.assertEqual(self.request("/item_feed?since=x").status_int, 400)
+	
+	def test_limit(self):
+		self.feed.limit = 3
+		self.assertEqual(self.changes()["since"], 3)
+		self.assertEqual(self.changes("?since=3")["since"], 4)
+	
+	def test_waiting_for_changes(self):
+		responses = []
+		thread = threading.Thread(target=lambda: responses.append(self.changes("?since=4&wait=1")))
+		thread.start()
+		FeedItemModel.create(name="c")
+		thread.join(5)
+		self.assertEqual([c["data"]["name"] for c in responses[0]["changes"]], ["c"])
+	
+	def test_waiting_ends_at_the_timeout(self):
+		self.feed.timeout = 0.05
+		self.assertEqual(self.changes("?since=4&wait=1"), {"changes": [], "since": 4})
+	
+	def test_server_sent_events(self):
+		response = self.request("/item_feed", headers={"Accept": "text/event-stream", "Last-Event-ID": "3"})
+		self.assertEqual(response.content_type, "text/event-stream")
+		self.assertTrue(response.body.startswith("retry: 10\n\nid: 4\nevent: destroy\ndata: {"))
+
+
+@support.needs_sdk
+class WarmupTest(support.AppTestCase):
+	
+	views = {
+		"page.html": "<p>{{ text }}</p>",
+		"items/index.html": "{% for i in items %}{{ i }}{% endfor %}",
+	}
+	
+	def setUp(self):
+		self.calls = []
+		super(WarmupTest, self).setUp()
+	
+	def configure(self, app):
+		@app.on_warmup
+		def fill_caches(app):
+			self.calls.append(app.router)
+	
+	def warm_up(self):
+		response = self.request("/_ah/warmup")
+		self.assertEqual(response.status_int, 200)
+		return response.json
+	
+	def test_report(self):
+		report = self.warm_up()
+		self.assertEqual(report["errors"], [])
+		self.assertEqual(report["template_count"], 2)
+		self.assertEqual(report["hooks"].keys(), ["fill_caches"])
+		self.assertEqual(self.calls, [self.app.router])		# Called with the app
+		self.assertEqual(len(server.jinja_env.cache), 2)		# The compiled templates are kept
+	
+	def test_instances_are_warmed_up_once(self):
+		report = self.warm_up()
+		self.assertEqual(self.warm_up(), report)
+		self.assertEqual(len(self.calls), 1)
+	
+	def test_failures_are_reported(self):
+		@self.app.on_warmup
+		def broken(app):
+			raise ValueError("no cache")
+		with open(self.views_dir + "/broken.html", "w") as f:
+			f.write("{% if %}")
+		
+		logging.disable(logging.ERROR)		# The failures are logged
+		try:
+			report = self.warm_up()
+		finally:
+			logging.disable(logging.NOTSET)
+		self.assertEqual(len(report["errors"]), 2)
+		self.assertEqual(report["errors"][0].split(":")[0], "broken.html")
+		self.assertEqual(report["errors"][1], "broken: no cache")
+		self.assertEqual(len(self.calls), 1)		# The other hooks are still called
+
+
+def download_controllers():
+	"""Make the controllers of DownloadTest."""
+	class File(server.DownloadController):
+		serve_blobs = False
+		chunk_size = 4
+		max_size = 10
+	
+	return [File]
+
+
+@support.needs_sdk
+class DownloadTest(support.AppTestCase):
+	
+	def setUp(self):
+		self.controllers = download_controllers()
+		super(DownloadTest, self).setUp()
+		self.create_blob("small", "abcdefgh")
+		self.create_blob("big", "x" * 20)
+	
+	def create_blob(self, key, content):
+		from google.appengine.api import datastore
+		entity = self.testbed.get_stub("blobstore").CreateBlob(key, content)
+		entity.update(dict(content_type="text/plain", filename=key + ".txt", md5_hash=key,
+						   creation=datetime.datetime(2020, 1, 1)))
+		datastore.Put(entity)
+	
+	def test_files_are_read_in_chunks(self):
+		response = self.request("/file/small")
+		self.assertEqual((response.status_int, response.body), (200, "abcdefgh"))
+		self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+		self.assertEqual(self.request("/file/missing").status_int, 404)
+	
+	def test_ranges(self):
+		response = self.request("/file/small/small.txt", headers={"Range": "bytes=2-6"})
+		self.assertEqual((response.status_int, response.body), (206, "cdefg"))
+		self.assertEqual(response.headers["Content-Range"], "bytes 2-6/8")
+		self.assertEqual(self.request("/file/small", headers={"Range": "bytes=8-"}).status_int, 416)
+	
+	def test_conditional_requests(self):
+		self.assertEqual(self.request("/file/small", headers={"If-None-Match": '"small"'}).status_int, 304)
+		self.assertEqual(self.request("/file/small", headers={"If-None-Match": '"old"'}).status_int, 200)
+	
+	def test_responses_over_the_maximum_size_are_refused(self):
+		response = self.request("/file/big", headers={"Range": "bytes=0-9"})
+		self.assertEqual((response.status_int, response.body), (206, "x" * 10))
+		response = self.request("/file/big", headers={"Range": "bytes=0-"})
+		self.assertEqual(response.status_int, 416)
+		self.assertEqual(response.headers["Content-Range"], "bytes */20")
+		logging.disable(logging.ERROR)		# The refusal is logged
+		try:
+			self.assertEqual(self.request("/file/big").status_int, 500)
+		finally:
+			logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,125 @@
+import logging
+import unittest
+
+import support
+from lib import tasks
+
+
+class RecordingExecutor(object):
+	"""Keeps the batches of calls it's given."""
+	
+	def __init__(self):
+		self.batches = []
+	
+	def submit(self, calls):
+		self.batches.append(list(calls))
+
+
+def work(*a, **kw):
+	pass
+
+
+class DeferTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.executor = RecordingExecutor()
+		self.previous = tasks.executor
+		tasks.set_executor(self.executor)
+		tasks._local.__dict__.clear()
+	
+	def tearDown(self):
+		tasks.set_executor(self.previous)
+		tasks._local.__dict__.clear()
+	
+	def test_outside_a_request_calls_are_sent_right_away(self):
+		tasks.defer(work, 1, x=2)
+		self.assertEqual(self.executor.batches, [[(work, (1,), {"x": 2})]])
+	
+	def test_calls_are_sent_together_when_the_request_succeeds(self):
+		tasks.begin()
+		tasks.defer(work, 1)
+		tasks.defer(work, 2)
+		self.assertEqual(self.executor.batches, [])
+		tasks.flush()
+		self.assertEqual(self.executor.batches, [[(work, (1,), {}), (work, (2,), {})]])
+	
+	def test_calls_of_a_failed_request_are_discarded(self):
+		tasks.begin()
+		tasks.defer(work, 1)
+		tasks.flush(discard=True)
+		self.assertEqual(self.executor.batches, [])
+		tasks.defer(work, 2)		# No request anymore
+		self.assertEqual(self.executor.batches, [[(work, (2,), {})]])
+	
+	def test_a_request_without_calls_submits_nothing(self):
+		tasks.begin()
+		tasks.flush()
+		self.assertEqual(self.executor.batches, [])
+	
+	def test_nested_requests_send_their_calls_with_the_outer_one(self):
+		tasks.begin()
+		tasks.defer(work, 1)
+		tasks.begin(nested=True)
+		tasks.defer(work, 2)
+		tasks.flush()
+		self.assertEqual(self.executor.batches, [])
+		tasks.flush()
+		self.assertEqual(self.executor.batches, [[(work, (1,), {}), (work, (2,), {})]])
+	
+	def test_a_failed_nested_request_keeps_the_outer_calls(self):
+		tasks.begin()
+		tasks.defer(work, 1)
+		tasks.begin(nested=True)
+		tasks.flush(discard=True)
+		tasks.flush()
+		self.assertEqual(self.executor.batches, [[(work, (1,), {})]])
+	
+	def test_the_calls_of_a_failed_nested_request_are_dropped(self):
+		tasks.begin()
+		tasks.defer(work, 1)
+		tasks.begin(nested=True)
+		tasks.defer(work, 2)
+		tasks.flush(discard=True)
+		tasks.begin(nested=True)
+		tasks.defer(work, 3)
+		tasks.flush()
+		tasks.flush()
+		self.assertEqual(self.executor.batches, [[(work, (1,), {}), (work, (3,), {})]])
+	
+	def test_a_nested_request_alone_starts_afresh(self):
+		tasks.begin(nested=True)
+		tasks.defer(work, 1)
+		tasks.flush()
+		self.assertEqual(self.executor.batches, [[(work, (1,), {})]])
+	
+	def test_a_request_ignores_what_a_previous_one_left_behind(self):
+		tasks.begin()
+		tasks.defer(work, 1)		# Never flushed, e.g. after a hard deadline
+		tasks.begin()
+		tasks.defer(work, 2)
+		tasks.flush()
+		self.assertEqual(self.executor.batches, [[(work, (2,), {})]])
+		tasks.defer(work, 3)
+		self.assertEqual(self.executor.batches[-1], [(work, (3,), {})])
+
+
+class LocalExecutorTest(unittest.TestCase):
+	
+	def setUp(self):
+		logging.disable(logging.ERROR)		# The failures are logged
+	
+	def tearDown(self):
+		logging.disable(logging.NOTSET)
+	
+	def test_failing_calls_are_retried_then_kept(self):
+		executor = tasks.LocalExecutor(retries=2)
+		executor.submit([(int, ("not a number",), {})])
+		self.assertEqual(executor.failed, [(int, ("not a number",), {})])
+	
+	def test_arguments_must_be_picklable(self):
+		executor = tasks.LocalExecutor()
+		self.assertRaises(Exception, executor.submit, [(work, (lambda: None,), {})])
+
+
+if __name__ == '__main__':
+	unittest.main()